@@ -0,0 +1,361 @@
+import os
+import sys
+import time
+import asyncio
+import json
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import threading
+import tracemalloc
+import functools
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import main as covid
+
+# first day of the JHU time series
+START = datetime.date(2020, 1, 22)
+
+
+def date_columns(days):
+    # headers like the JHU files use, 1/22/20
+    dates = [START + datetime.timedelta(days=d) for d in range(days)]
+    return [f'{d.month}/{d.day}/{d:%y}' for d in dates]
+
+
+def daily_counts(rng, regions, days, scale):
+    # new cases per region and day, in waves that start on different days
+    t = np.arange(days)
+    waves = 1 + np.sin(t / 60.0)[np.newaxis, :] * \
+        rng.uniform(0.3, 1.0, (regions, 1))
+    rate = rng.gamma(0.5, scale, (regions, 1)) * waves
+    daily = rng.poisson(rate)
+    daily[t < rng.integers(0, days // 4 + 1, (regions, 1))] = 0
+
+    # corrections now and then, which make the cumulative counts drop
+    fix = rng.random((regions, days)) < 0.002
+    daily[fix] = -rng.integers(1, 20, fix.sum())
+    return daily
+
+
+def reported(rng, daily):
+    # cumulative counts as reported: some regions only report every few
+    # days and every region misses a day now and then, so the totals stall
+    # in zero runs and catch up on the next report
+    regions, days = daily.shape
+    cum = np.cumsum(daily, axis=1)
+    every = rng.choice([1, 1, 1, 2, 7], (regions, 1))
+    report = (np.arange(days) % every == 0) & \
+        (rng.random((regions, days)) > 0.05)
+    report[:, 0] = True
+    last = np.where(report, np.arange(days), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    return np.take_along_axis(cum, last, axis=1)
+
+
+def us_meta(first, regions, states):
+    # UID ... Combined_Key for a chunk of the US rows, Wake County, North
+    # Carolina is always there so generate_docs() has its pages
+    rows = np.arange(first, first + regions)
+    state = np.asarray(states, dtype=object)[rows % len(states)]
+    county = np.array([f'County {i}' for i in rows // len(states)],
+                      dtype=object)
+    county[rows // len(states) == 1] = 'Unassigned'
+    county[rows == 0] = 'Wake'
+    fips = 1000 * (rows % len(states) + 1) + rows // len(states)
+    return pd.DataFrame({
+        'UID': 84000000 + fips, 'iso2': 'US', 'iso3': 'USA', 'code3': 840,
+        'FIPS': fips.astype(float), 'Admin2': county,
+        'Province_State': state, 'Country_Region': 'US',
+        'Lat': 35.0 + rows % 10, 'Long_': -78.0 - rows % 10,
+        'Combined_Key': county + ', ' + state + ', US'})
+
+
+def global_meta(first, regions):
+    # Province/State ... Long for a chunk of the global rows, every fifth
+    # country is split into provinces
+    rows = np.arange(first, first + regions)
+    split = rows // 5 % 5 == 0
+    country = np.array([f'Country {i - i % 5}' if s else f'Country {i}'
+                        for i, s in zip(rows, split)], dtype=object)
+    province = np.array([f'Province {i % 5}' if s else np.nan
+                         for i, s in zip(rows, split)], dtype=object)
+    return pd.DataFrame({'Province/State': province,
+                         'Country/Region': country,
+                         'Lat': 10.0 + rows % 50, 'Long': 20.0 + rows % 50})
+
+
+def write_csv(path, meta, counts, dates, header):
+    frame = pd.concat([meta, pd.DataFrame(counts, columns=dates,
+                                          index=meta.index)], axis=1)
+    frame.to_csv(path, mode='w' if header else 'a', header=header,
+                 index=False)
+
+
+def make_dataset(folder, regions=3000, global_regions=280, days=1000,
+                 states=58, seed=0, chunk=2000):
+    # write all four files in the JHU schema, a chunk of rows at a time so
+    # even the largest sizes fit in memory
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dates = date_columns(days)
+    names = ['North Carolina'] + [f'State {i}' for i in range(1, states)]
+    paths = {f: os.path.join(folder, f) for f in covid.files}
+    for scope, total in [('US', regions), ('global', global_regions)]:
+        for first in range(0, total, chunk):
+            size = min(chunk, total - first)
+            if scope == 'US':
+                meta = us_meta(first, size, names)
+            else:
+                meta = global_meta(first, size)
+            scale = 40 if scope == 'US' else 400
+            cases = daily_counts(rng, size, days, scale)
+            deaths = rng.binomial(np.maximum(cases, 0), 0.015)
+            for mode, daily in [('confirmed', cases), ('deaths', deaths)]:
+                block = meta
+                if scope == 'US' and mode == 'deaths':
+                    block = meta.assign(
+                        Population=rng.integers(1000, 1000000, size))
+                path = paths[f'time_series_covid19_{mode}_{scope}.csv']
+                write_csv(path, block, reported(rng, daily), dates,
+                          first == 0)
+    return folder
+
+
+def serve_folder(folder):
+    # plain http server for the synthetic files, it answers conditional
+    # requests with 304 like the real one does
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    handler = functools.partial(QuietHandler, directory=folder)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/'
+
+
+def measure(func, repeat, setup=None):
+    # median and best wall time over repeat runs, then one more run under
+    # tracemalloc for the peak memory, kept apart since tracing slows it
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'median_s': statistics.median(times), 'min_s': min(times),
+            'runs': repeat, 'peak_mb': peak / 2**20}
+
+
+def run(data, workdir, repeat):
+    # point main.py at a scratch copy of the project and time every stage
+    covid.DIR_PATH = workdir
+    covid.set_html_options()
+    covid.set_cache_options(0)
+    covid.make_dirs()
+    shutil.copytree(os.path.join(os.path.dirname(__file__), 'docs'),
+                    os.path.join(workdir, 'docs'), dirs_exist_ok=True)
+    server, url = serve_folder(data)
+    results = {}
+
+    def cold():
+        # no local files, so everything is downloaded and converted
+        shutil.rmtree(os.path.join(workdir, 'input'))
+        covid.make_dirs()
+        covid.clear_datasets()
+
+    try:
+        results['download_cold'] = measure(
+            lambda: covid.download_files(url), repeat, cold)
+        results['download_unchanged'] = measure(
+            lambda: covid.download_files(url), repeat)
+        # download, ingest and render of a county's pages overlapped
+        results['pipeline_cold'] = measure(
+            lambda: asyncio.run(covid.pipeline(['Wake, North Carolina'],
+                                               url)), repeat, cold)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    results['load'] = measure(
+        lambda: [covid.load_cube(file) for file in covid.files], repeat,
+        covid.clear_datasets)
+
+    # the data quality pass over every county
+    results['anomaly_report'] = measure(
+        lambda: covid.anomaly_report(covid.files[0]), repeat)
+    results['redistribute'] = measure(
+        lambda: covid.redistribute(covid.load_cube(covid.files[0]).new),
+        repeat)
+
+    state, county = 'North Carolina', 'Wake'
+    plots = [('confirmed_county', (state, county)),
+             ('new_county', (state, county)),
+             ('confirmed_state', (state,)), ('new_state', (state,)),
+             ('confirmed_by_county', (state,)), ('new_by_county', (state,)),
+             ('confirmed_by_state', ()), ('new_by_state', ())]
+    for name, args in plots:
+        for mode in ['cases', 'deaths']:
+            plot = getattr(covid, name)
+            results[f'{name}_{mode}'] = measure(
+                lambda: plot(*args, mode=mode, show=False), repeat)
+
+    def rebuild():
+        # without the manifest every page of docs/ is built again
+        manifest = os.path.join(workdir, 'docs', 'manifest.json')
+        if os.path.exists(manifest):
+            os.remove(manifest)
+
+    results['generate_docs'] = measure(covid.generate_docs, repeat, rebuild)
+    results['generate_docs_unchanged'] = measure(covid.generate_docs, repeat)
+    return results
+
+
+def fill_zeros(new):
+    # the zero filling as the plot functions originally did it, a day at a
+    # time, kept as the reference covid.daily_new() must match exactly
+    # a run of zeros followed by a nonzero day is replaced by the average of
+    # that day's count, spread over the run and the day itself
+    new = list(new)
+    length = 0
+    for idx, val in enumerate(new):
+        if val == 0:
+            for length, zero in enumerate(new[idx+1:]):
+                if zero != 0:
+                    break
+            length += 1
+            if idx+length >= len(new) and new[-1] == 0:
+                break
+            mean = new[idx+length] // (length+1)
+            new[idx+length] = new[idx+length] - mean * (length)
+            for i in range(length):
+                new[idx+i] = mean
+    return new
+
+
+def check(seed, series=2000):
+    # series that differ between covid.daily_new() and the reference, on
+    # random cumulative counts with stalls, long zero runs and drops
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    for days in rng.integers(1, 200, series // 100):
+        daily = daily_counts(rng, 50, days, rng.uniform(0.5, 50))
+        daily[rng.random(daily.shape) < 0.02] *= -1
+        batch = [reported(rng, daily), np.cumsum(daily, axis=1),
+                 np.where(rng.random(daily.shape) < 0.5, 0,
+                          rng.integers(-5, 30, daily.shape)).cumsum(axis=1)]
+        for confirmed in batch:
+            new = covid.daily_new(confirmed.transpose()).transpose()
+            for row, got in zip(confirmed, new):
+                expected = fill_zeros(np.diff(row, prepend=0).tolist())
+                if got.tolist() != expected or \
+                        covid.daily_new(row).tolist() != expected:
+                    mismatches += 1
+    return mismatches
+
+
+def compare(results, baseline, threshold):
+    # stages that got slower or bigger than the baseline by more than the
+    # threshold, ignoring differences too small to be more than noise
+    # the best time is compared since it varies least from run to run
+    regressions = []
+    for name, new in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        for metric, floor in [('min_s', 0.005), ('peak_mb', 1.0)]:
+            if new[metric] > old[metric] * (1 + threshold) and \
+                    new[metric] - old[metric] > floor:
+                regressions.append((name, metric, old[metric], new[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time covid.py on synthetic Johns Hopkins data.')
+    parser.add_argument('--regions', type=int, default=3000,
+                        help='US counties (default: %(default)s)')
+    parser.add_argument('--global-regions', type=int, default=280,
+                        help='global provinces/countries '
+                             '(default: %(default)s)')
+    parser.add_argument('--days', type=int, default=1000,
+                        help='days of data (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per stage (default: %(default)s)')
+    parser.add_argument('--data', help='keep the synthetic files here and '
+                                       'reuse them if they exist')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='results file (default: %(default)s)')
+    parser.add_argument('--baseline',
+                        help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown before a stage is flagged '
+                             '(default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+                        help='only check that new counts match the '
+                             'original loop on random series')
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = check(args.seed)
+        if mismatches:
+            print(f'{mismatches} series differ from the original loop')
+            sys.exit(1)
+        print('New counts match the original loop')
+        return
+
+    config = {'regions': args.regions, 'global_regions': args.global_regions,
+              'days': args.days, 'seed': args.seed}
+    scratch = tempfile.mkdtemp(prefix='covid-benchmark-')
+    try:
+        data = args.data or os.path.join(scratch, 'data')
+        if not all(os.path.exists(os.path.join(data, f))
+                   for f in covid.files):
+            started = time.perf_counter()
+            make_dataset(data, args.regions, args.global_regions, args.days,
+                         seed=args.seed)
+            print(f'Generated data in {time.perf_counter() - started:.1f}s')
+        workdir = os.path.join(scratch, 'work')
+        os.makedirs(workdir)
+        results = {'config': config, 'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'date': datetime.datetime.now().isoformat(),
+                   'results': run(data, workdir, args.repeat)}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for name, r in results['results'].items():
+        print(f"{name:32} {r['median_s'] * 1000:10.1f} ms "
+              f"{r['peak_mb']:10.1f} MB")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print('Baseline was run on different data, comparing anyway')
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            print(f'REGRESSION {name} {metric}: {old:.4g} -> {new:.4g}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
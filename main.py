@@ -1,17 +1,145 @@
 import os
+import collections
+import numpy as np
 import pandas as pd
+import plotly
 import plotly.express as px
 import plotly.graph_objects as go
 import requests
-import filecmp
 import shutil
 import datetime
+import time
+import argparse
+import hashlib
+import json
+import gzip
+import pickle
+import sys
+import threading
+import urllib.parse
+import atexit
+import contextlib
+import functools
+import tracemalloc
+import asyncio
+import tempfile
+import bisect
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 base_url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/'
 files = ['time_series_covid19_confirmed_US.csv', 'time_series_covid19_confirmed_global.csv',
          'time_series_covid19_deaths_US.csv', 'time_series_covid19_deaths_global.csv']
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# days of spare room left at the end of each cached count block
+SPARE_DAYS = 64
+
+# counts parsed at a time when converting a csv, which bounds the memory
+# used however big the file is
+CHUNK_CELLS = 1 << 21
+
+# how pages load plotly.js, whether they are also gzipped and how the by
+# county/state traces are drawn, see set_html_options()
+PLOTLYJS = 'shared'
+PRECOMPRESS = False
+WEBGL = False
+MAX_POINTS = None
+
+# one pooled session, so every request reuses the same connections
+session = requests.Session()
+
+# trace events of every stage while profiling, None when it is off
+PROFILE = None
+# peaks of the main thread's open stages, innermost last
+_peaks = []
+_no_stage = contextlib.nullcontext()
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def set_profile(enabled=True):
+    # start or stop recording stages, see stage()
+    global PROFILE
+    PROFILE = [] if enabled else None
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def stage(name):
+    # time a stage of the pipeline: wall and cpu time, the peak of traced
+    # memory on the main thread and the process's max rss so far, costs
+    # one check when profiling is off
+    if PROFILE is None:
+        return _no_stage
+    return _stage(name)
+
+
+@contextlib.contextmanager
+def _stage(name):
+    # tracemalloc's peak is shared by the whole process, so only stages on
+    # the main thread reset it and record it, others only record times
+    # a stage resets the peak, so its parent's peak so far is kept first
+    main = threading.current_thread() is threading.main_thread()
+    if main:
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        _peaks.append(0)
+    started, cpu = time.perf_counter_ns(), time.thread_time_ns()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter_ns() - started
+        cpu = time.thread_time_ns() - cpu
+        args = {'cpu_ms': cpu / 1e6}
+        if main:
+            peak = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+            args['peak_traced_mb'] = peak / 2**20
+        if resource:
+            # the most the process has used since it started, not just
+            # during this stage, in kilobytes on linux
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            args['process_max_rss_mb'] = rss / 1024
+        PROFILE.append({'name': name, 'cat': 'stage', 'ph': 'X',
+                        'ts': started / 1000, 'dur': wall / 1000,
+                        'pid': os.getpid(), 'tid': threading.get_ident(),
+                        'args': args})
+
+
+def profiled(func):
+    # run every call of func as a stage named after it
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if PROFILE is None:
+            return func(*args, **kwargs)
+        with _stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def write_profile(path):
+    # trace event json, which loads in chrome://tracing or ui.perfetto.dev
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': PROFILE, 'displayTimeUnit': 'ms'}, f)
+
+    # and the stages that took longest in total
+    totals = collections.Counter()
+    for event in PROFILE:
+        totals[event['name']] += event['dur'] / 1000
+    print(f'Profile written to {path}')
+    for name, ms in totals.most_common(10):
+        print(f'{ms:10.1f} ms  {name}')
+
 
 def make_dirs():
     if not os.path.exists(f'{DIR_PATH}/input'):
@@ -21,186 +149,1603 @@ def make_dirs():
         os.makedirs(f'{DIR_PATH}/output')
 
 
-def check_updates():
-    # request and download txt
-    r = requests.get(base_url + files[0])
-    content = r.content.decode('utf-8')
+# downloads are kept as snapshots in input/versions/, a folder per version
+# named by the hash of its files, and input/current names the newest one
+# a snapshot is never modified once published, so a process can keep
+# reading the one it started with while another downloads the next
+KEEP_VERSIONS = 3
+
+# snapshot folder this process reads from, see data_dir()
+_pinned = None
+
+
+def versions_dir():
+    return f'{DIR_PATH}/input/versions'
 
-    # requests downloads the content, create a new file to store the data
-    with open(f"{DIR_PATH}/new.csv", "w") as f:
-        f.write(content)
 
-    # see if files match
+def data_dir():
+    # pinned on first use and only moved on by clear_datasets(), input/
+    # itself is read when nothing has been downloaded into a snapshot yet
+    global _pinned
+    if _pinned is None:
+        folder = f'{DIR_PATH}/input'
+        pointer = f'{DIR_PATH}/input/current'
+        if os.path.exists(pointer):
+            with open(pointer, "r") as f:
+                version = f.read().strip()
+            if version and os.path.isdir(f'{versions_dir()}/{version}'):
+                folder = f'{versions_dir()}/{version}'
+        _pinned = folder
+    return _pinned
+
+
+def sync_path(path):
+    # flush a file or folder to disk, folders can't be opened on windows
+    # and are skipped there
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_durably(path, text):
+    # a reader sees either the old file or the whole new one
+    part = f'{path}.{os.getpid()}.part'
+    with open(part, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(part, path)
+    sync_path(os.path.dirname(path))
+
+
+def read_validators(folder):
+    path = f"{folder}/validators.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def latest_validators(current):
+    # the validators the current snapshot was downloaded with, or the ones
+    # in input/validators.json where a later check got the same data back
+    # with new validators, since a published snapshot is never rewritten
+    validators = read_validators(current)
+    for file, validator in read_validators(f'{DIR_PATH}/input').items():
+        sha = (validators.get(file) or {}).get('sha256')
+        if sha and (validator or {}).get('sha256') == sha:
+            validators[file] = validator
+    return validators
+
+
+def link_or_copy(src, dst):
+    # unchanged files are shared between snapshots, copied where the file
+    # system has no hard links
     try:
-        filecmp.cmp(f"{DIR_PATH}/old.csv", f"{DIR_PATH}/new.csv")
-    except IOError:
-        # old file doesn't exist yet, create empty file
-        f = open(f"{DIR_PATH}/old.csv", "w")
-        f.close()
-
-    # files match, no new forms submitted
-    if filecmp.cmp(f"{DIR_PATH}/old.csv", f"{DIR_PATH}/new.csv"):
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def publish(staging, version):
+    # everything is on disk before the folder is renamed into place, and the
+    # folder is in place before current points at it
+    for name in os.listdir(staging):
+        sync_path(os.path.join(staging, name))
+    sync_path(staging)
+    target = f'{versions_dir()}/{version}'
+    try:
+        os.rename(staging, target)
+    except OSError:
+        # another process already published the same data
+        if not os.path.isdir(target):
+            raise
+        shutil.rmtree(staging, ignore_errors=True)
+    sync_path(versions_dir())
+    write_durably(f'{DIR_PATH}/input/current', version)
+
+
+def prune_versions(keep=KEEP_VERSIONS):
+    # drop all but the newest snapshots, and staging folders left behind by
+    # runs that died more than a day ago
+    # a process still reading a dropped snapshot keeps its open files
+    folder = versions_dir()
+    if not os.path.isdir(folder):
+        return
+    with open(f'{DIR_PATH}/input/current', "r") as f:
+        current = f.read().strip()
+    entries = [e for e in os.scandir(folder) if e.is_dir()]
+    staging = [e for e in entries if e.name.startswith('.staging-')]
+    for entry in staging:
+        if time.time() - entry.stat().st_mtime > 86400:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    published = sorted((e for e in entries if e not in staging),
+                       key=lambda e: e.stat().st_mtime, reverse=True)
+    kept = 1
+    for entry in published:
+        if entry.name == current:
+            continue
+        if kept < keep:
+            kept += 1
+        else:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def check_updates(url=None):
+    # conditionally download every file, only changed files get written
+    changed = download_files(url)
+
+    # nothing changed upstream, no new data
+    if not changed:
         print("No updates. Exiting...")
         return False
-    # files don't match, so process new data
+    # something changed, so process new data
     else:
         print("Updates! Proceeding... ")
-        with open(f"{DIR_PATH}/new.csv", "r") as f:
-            contents = f.read()
-        with open(f"{DIR_PATH}/old.csv", "w") as f:
-            f.write(contents)
         return True
 
 
-def download_files():
-    # request and download txt
-    for file in files:
-        r = requests.get(base_url + file)
-        content = r.content.decode('utf-8')
-        with open(f"{DIR_PATH}/input/{file}", "w") as f:
-            f.write(content)
-
+def fetch_file(file, validator, url, current, staging):
+    # returns the file's new validator and whether its contents changed
+    # the copy in current is compared against, a changed file is written
+    # to staging
+    with stage(f'fetch {file}'):
+        return _fetch_file(file, validator, url, current, staging)
+
+
+def _fetch_file(file, validator, url, current, staging):
+    path = f"{staging}/{file}"
+    exists = os.path.exists(f"{current}/{file}")
+
+    # ask the server to skip the body if it hasn't changed since last time
+    headers = {}
+    if validator and exists:
+        if validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator.get('last_modified'):
+            headers['If-Modified-Since'] = validator['last_modified']
+
+    with stage('request'):
+        r = session.get(url + file, headers=headers, stream=True, timeout=60)
+    with r:
+        # 304 Not Modified, the local copy is still current
+        if r.status_code == 304:
+            return validator, False
+        r.raise_for_status()
+
+        # stream the body to disk in chunks, hashing it on the way
+        digest = hashlib.sha256()
+        with stage('stream'), open(f"{path}.part", "wb") as f:
+            for chunk in r.iter_content(chunk_size=1 << 16):
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        new = {'etag': r.headers.get('ETag'),
+               'last_modified': r.headers.get('Last-Modified'),
+               'sha256': digest.hexdigest()}
+
+    # servers that ignore the validators resend the same body
+    if validator and exists and validator.get('sha256') == new['sha256']:
+        os.remove(f"{path}.part")
+        return new, False
+    os.replace(f"{path}.part", path)
+    return new, True
+
+
+def copy_cache(file, src, dst, link=False):
+    # put a file and its cache from snapshot src into dst, a cache that will
+    # be updated is copied, so the snapshot it came from is left as it was
+    for name in [file] + [os.path.basename(cache_path(file, ext))
+                          for ext in CACHE_EXTS]:
+        if os.path.exists(f"{src}/{name}") and \
+                not os.path.exists(f"{dst}/{name}"):
+            (link_or_copy if link else shutil.copy2)(f"{src}/{name}",
+                                                     f"{dst}/{name}")
+
+
+def refresh_file(file, validator, url, current, staging, ready=None):
+    # download a file and ingest it right away if it changed, while the
+    # other files are still downloading
+    # ready(file, cube) is called once its cache is current, unchanged
+    # files are read from the current snapshot
+    validator, new = fetch_file(file, validator, url, current, staging)
+    folder = None
+    if new:
+        copy_cache(file, current, staging)
+        with stage(f'ingest {file}'):
+            ingest_file(file, staging)
+        folder = staging
+    elif cache_fresh(file, current):
+        folder = current
+    if ready and folder:
+        ready(file, clean_cube(read_cube(file, folder)))
+    return validator, new, folder
+
+
+def download_files(url=None, ready=None):
+    # the snapshot read so far, and the validators (ETag, Last-Modified,
+    # hash) it was downloaded with
+    current = data_dir()
+    validators = latest_validators(current)
+
+    # request every file at once over the shared session, changed files
+    # land in a staging folder that becomes the next snapshot
+    os.makedirs(versions_dir(), exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.staging-', dir=versions_dir())
+    try:
+        url = url or base_url
+        with ThreadPoolExecutor(max_workers=len(files)) as pool:
+            results = list(pool.map(
+                lambda file: refresh_file(file, validators.get(file), url,
+                                          current, staging, ready), files))
+        changed, stale = [], []
+        for file, (validator, new, folder) in zip(files, results):
+            validators[file] = validator
+            if new:
+                changed.append(file)
+            elif folder is None:
+                stale.append(file)
+
+        # same data, only the validators are new, and they are kept
+        # outside the snapshot so it stays as it was published
+        if not changed:
+            shutil.rmtree(staging)
+            write_durably(f"{DIR_PATH}/input/validators.json",
+                          json.dumps(validators, indent=2))
+            for file in stale:
+                if ready:
+                    ready(file, load_cube(file))
+            return changed
+
+        # files that didn't change are shared with the current snapshot
+        # unless their cache still has to be updated
+        for file in files:
+            if file not in changed:
+                copy_cache(file, current, staging, link=file not in stale)
+        for file in stale:
+            with stage(f'ingest {file}'):
+                ingest_file(file, staging)
+            if ready:
+                ready(file, clean_cube(read_cube(file, staging)))
+        write_durably(f"{staging}/validators.json",
+                      json.dumps(validators, indent=2))
+        publish(staging, content_version(validators, staging))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    # anything loaded before this point is stale now
+    clear_datasets()
+    prune_versions()
+    return changed
+
+
+# .npz holds the dates and region metadata, .npy the cumulative counts
+# and .new.npy the new counts each day
+CACHE_EXTS = ['.npz', '.npy', '.new.npy']
+
+
+def cache_path(file, ext='.npz', folder=None):
+    # binary copies of an input csv, stored next to it
+    return f'{folder or data_dir()}/{os.path.splitext(file)[0]}{ext}'
+
+
+def cache_fresh(file, folder=None):
+    # the .npz is written last, so it is only newer than the csv once the
+    # whole cache is
+    cache = cache_path(file, '.npz', folder)
+    return os.path.exists(cache) and \
+        os.path.getmtime(cache) >= os.path.getmtime(
+            f'{folder or data_dir()}/{file}')
+
+
+def read_header(path):
+    # split a csv's header into region metadata columns and date columns
+    header = pd.read_csv(path, nrows=0, encoding='utf-8').columns
+    dates = pd.to_datetime(header, format='%m/%d/%y', errors='coerce')
+    counts = [col for col, date in zip(header, dates) if not pd.isna(date)]
+    meta = [col for col in header if col not in counts]
+    return meta, counts, dates.dropna()
+
+
+def region_columns(columns):
+    # the columns naming a region: (state, county) in the US files and
+    # (country, province) in the global files
+    if 'Country/Region' in columns:
+        return ['Country/Region', 'Province/State']
+    return ['Province_State', 'Admin2']
+
+
+def count_rows(path):
+    # lines of data in a csv, counted without parsing it
+    # an upper bound on the rows, as blank lines and quoted newlines count
+    lines, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines - 1 + (last != b'\n')
+
+
+def sum_regions(counts, top):
+    # cumulative counts summed per state or country, a row each in name
+    # order, as one segment sum over the rows sorted by state
+    names, codes = np.unique(np.asarray(top, dtype=str), return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    counts = np.asarray(counts, dtype='int64')
+    sums = np.add.reduceat(counts[order], starts, axis=0) if len(starts) \
+        else np.zeros((0, counts.shape[1]), dtype='int64')
+    return pd.DataFrame(sums, index=names)
+
+
+def aggregate(totals):
+    # the levels above the regions: the cumulative counts of every state
+    # (or country) and of the whole nation, and the new counts of each
+    # computed from those cumulative counts like the state pages always have
+    totals = totals.to_numpy(dtype='int64')
+    nation = totals.sum(axis=0)
+    return {'totals': totals,
+            'totals_new': daily_new(totals.transpose()).transpose(),
+            'nation': nation, 'nation_new': daily_new(nation)}
+
+
+def save_meta(file, meta, dates, totals, folder=None):
+    # totals are the counts of every state or country, summed on ingest
+    # the levels above them are computed once here for every new version
+    arrays = {'dates': np.asarray(dates, dtype='datetime64[D]'),
+              'columns': np.array(list(meta.columns), dtype=str),
+              'groups': np.array(list(totals.index), dtype=str),
+              **aggregate(totals)}
+
+    # text columns (state, county, ...) are stored as categorical codes
+    # numeric columns (FIPS, Lat, Population, ...) as plain floats
+    for i, col in enumerate(meta.columns):
+        if pd.api.types.is_numeric_dtype(meta[col]):
+            arrays[f'values{i}'] = meta[col].to_numpy(dtype='float64')
+        else:
+            codes, categories = pd.factorize(meta[col])
+            arrays[f'codes{i}'] = codes.astype('int32')
+            arrays[f'categories{i}'] = np.array(categories, dtype=str)
+
+    # replaced rather than rewritten, the old file may be linked from an
+    # older snapshot
+    path = cache_path(file, '.npz', folder)
+    with open(f'{path}.part', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(f'{path}.part', path)
+
+
+def open_block(file, ext, days, folder=None):
+    # int32 block with a row per region and room for at least this many days
+    # spare columns are reserved up front so a new day is written in place,
+    # the file is only rewritten once the spare columns run out
+    path = cache_path(file, ext, folder)
+    block = np.load(path, mmap_mode='r+')
+    if block.shape[1] < days:
+        grown = np.lib.format.open_memmap(
+            f'{path}.part', mode='w+', dtype='int32',
+            shape=(len(block), days + SPARE_DAYS))
+        grown[:, :block.shape[1]] = block
+        grown.flush()
+        del block, grown
+        os.replace(f'{path}.part', path)
+        block = np.load(path, mmap_mode='r+')
+    return block
+
+
+def trim_block(path, rows):
+    # keep only the first rows of a saved block, through a copy
+    block = np.load(path, mmap_mode='r')
+    trimmed = np.lib.format.open_memmap(f'{path}.trim', mode='w+',
+                                        dtype=block.dtype,
+                                        shape=(rows,) + block.shape[1:])
+    trimmed[:] = block[:rows]
+    trimmed.flush()
+    del block, trimmed
+    os.replace(f'{path}.trim', path)
+
+
+@profiled
+def convert_file(file, folder=None):
+    # read just the header first so every column gets an explicit dtype
+    # date columns hold whole numbers, everything else is region metadata
+    folder = folder or data_dir()
+    path = f'{folder}/{file}'
+    meta, counts, dates = read_header(path)
+    rows = count_rows(path)
+    top = region_columns(meta)[0]
+
+    # counts are stored with a row per region, so that a single region can
+    # be read from the memory mapped file in one go
+    # they are written to new files, and only replace the old ones once done
+    parts = [f'{cache_path(file, ext, folder)}.part'
+             for ext in ['.npy', '.new.npy']]
+    try:
+        blocks = [np.lib.format.open_memmap(
+            part, mode='w+', dtype='int32',
+            shape=(rows, len(counts) + SPARE_DAYS)) for part in parts]
+
+        # the csv is streamed a chunk of rows at a time straight into the
+        # cache, so only one chunk of counts is ever in memory, and each
+        # state's or country's totals are summed along the way
+        reader = pd.read_csv(
+            path, encoding='utf-8', dtype={col: 'int32' for col in counts},
+            chunksize=max(1, CHUNK_CELLS // max(1, len(counts))))
+        chunks, totals, row = [], sum_regions(np.zeros((0, len(counts))),
+                                              []), 0
+        for cvDF in reader:
+            with stage('chunk'):
+                values = cvDF[counts].to_numpy(dtype='int32')
+                end = row + len(values)
+                if end > rows:
+                    raise ValueError(f'{file} has more rows than lines')
+                blocks[0][row:end, :len(counts)] = values
+                blocks[1][row:end, :len(counts)] = \
+                    daily_new(values.transpose()).transpose()
+                totals = totals.add(sum_regions(values, cvDF[top]),
+                                    fill_value=0)
+                chunks.append(cvDF[meta])
+                row = end
+        with stage('save'):
+            for block in blocks:
+                block.flush()
+            del blocks
+
+            # blank lines and quoted newlines make the line count only an
+            # upper bound, so the blocks are cut down to the rows read
+            if row < rows:
+                for part in parts:
+                    trim_block(part, row)
+            for part in parts:
+                os.replace(part, part[:-len('.part')])
+
+            # written last, so the cache only looks current once complete
+            meta = pd.concat(chunks, ignore_index=True) if chunks else \
+                pd.DataFrame(columns=meta)
+            save_meta(file, meta, dates, totals, folder)
+    except BaseException:
+        for part in parts:
+            for leftover in [part, f'{part}.trim']:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        raise
+
+
+@profiled
+def append_file(file, folder=None):
+    # add only the days that are new since the cache was written
+    # returns False when the csv isn't just the cache plus more days
+    folder = folder or data_dir()
+    path = f'{folder}/{file}'
+    if not all(os.path.exists(cache_path(file, ext, folder))
+               for ext in CACHE_EXTS):
+        return False
+    cube = read_cube(file, folder)
+    meta, counts, dates = read_header(path)
+    days = len(cube.dates)
+    if not days or list(cube.meta.columns) != meta or \
+            len(dates) <= days or not np.array_equal(
+                np.asarray(dates[:days], dtype='datetime64[D]'),
+                np.asarray(cube.dates, dtype='datetime64[D]')):
+        return False
 
-def confirmed_county(state, county, mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
+    # every cached day must match the csv, as past days get revised, so
+    # the counts are checked a chunk of rows at a time and only the
+    # metadata and the new days are kept
+    with stage('read_csv'):
+        reader = pd.read_csv(
+            path, encoding='utf-8', dtype={col: 'int32' for col in counts},
+            chunksize=max(1, CHUNK_CELLS // len(counts)))
+        chunks, added, row = [], [], 0
+        for chunk in reader:
+            values = chunk[counts].to_numpy(dtype='int32')
+            end = row + len(values)
+            if end > len(cube.meta) or not np.array_equal(
+                    values[:, :days], cube.counts[row:end]):
+                return False
+            chunks.append(chunk[meta])
+            added.append(values[:, days:])
+            row = end
+    if row != len(cube.meta) or not chunks:
+        return False
+    cvDF = pd.concat(chunks, ignore_index=True)
+    added = np.concatenate(added)
+
+    # the regions must match what is stored
+    for col in meta:
+        if pd.api.types.is_numeric_dtype(cube.meta[col]):
+            same = np.array_equal(cvDF[col].to_numpy(dtype='float64'),
+                                  cube.meta[col].to_numpy(), equal_nan=True)
+        else:
+            same = cvDF[col].astype(object).equals(
+                cube.meta[col].astype(object))
+        if not same:
+            return False
+
+    # write the new days into the spare columns
+    total = len(dates)
+    cumulative = open_block(file, '.npy', total, folder)
+    cumulative[:, days:total] = added
+    cumulative.flush()
+
+    # only a region's trailing zeros can still be filled in by the new days
+    # everything before its last nonzero day is already settled
+    new = open_block(file, '.new.npy', total, folder)
+    nonzero = new[:, :days] != 0
+    trailing = np.where(nonzero.any(axis=1),
+                        nonzero[:, ::-1].argmax(axis=1), days)
+    raw = np.diff(cumulative[:, days-1:total].astype('int64'), axis=1)
+    # a few regions may have had no cases for over a month, those are redone
+    # separately so the rest only needs a short window
+    for rows in [np.flatnonzero(trailing <= 31),
+                 np.flatnonzero(trailing > 31)]:
+        if not rows.size:
+            continue
+        span = trailing[rows].max()
+        block = np.zeros((span + total - days, rows.size), dtype='int64')
+        block[span:] = raw[rows].transpose()
+        start = span - trailing[rows]
+        block = fill_gaps(block, start)
+        day = np.arange(len(block))[:, np.newaxis]
+        window = new[rows, days-span:total].transpose()
+        new[rows, days-span:total] = np.where(
+            day >= start, block, window).transpose()
+    new.flush()
+    del cumulative, new
+
+    # the totals only need the new days added
+    top = region_columns(meta)[0]
+    added = sum_regions(added, cvDF[top]).reindex(cube.totals.index,
+                                                  fill_value=0)
+    totals = pd.DataFrame(np.hstack([cube.totals.to_numpy(dtype='int64'),
+                                     added.to_numpy(dtype='int64')]),
+                          index=cube.totals.index)
+    save_meta(file, cube.meta, dates, totals, folder)
+    return True
+
+
+@profiled
+def ingest_file(file, folder=None):
+    # append new days to the cache when possible, otherwise rebuild it
+    if not append_file(file, folder):
+        convert_file(file, folder)
+
+
+def region_rows(meta):
+    # look up a region's row by its name, UID or FIPS code
+    # names are (state, county) in the US files and (country, province) in
+    # the global files, members lists the rows of each state or country
+    names = region_columns(meta)
+    rows = {'name': {}, 'uid': {}, 'fips': {}}
+    for row, key in enumerate(zip(*[meta[col] for col in names])):
+        rows['name'].setdefault(key, row)
+    for col in ['UID', 'FIPS']:
+        if col in meta:
+            for row, code in enumerate(meta[col]):
+                if not np.isnan(code):
+                    rows[col.lower()].setdefault(int(code), row)
+    top = np.asarray(meta[names[0]], dtype=object)
+    rows['members'] = pd.Series(np.arange(len(top))).groupby(top).indices
+    return rows
+
+
+def read_cube(file, folder=None):
+    with np.load(cache_path(file, '.npz', folder)) as arrays:
+        meta = {}
+        for i, col in enumerate(arrays['columns']):
+            if f'values{i}' in arrays:
+                meta[col] = arrays[f'values{i}']
+            else:
+                meta[col] = pd.Categorical.from_codes(
+                    arrays[f'codes{i}'], arrays[f'categories{i}'])
+        dates = pd.DatetimeIndex(arrays['dates'])
+        levels = None
+        if 'nation' in arrays:
+            levels = {key: arrays[key] for key in
+                      ['totals', 'totals_new', 'nation', 'nation_new']}
+            groups = arrays['groups']
+    meta = pd.DataFrame(meta)
+
+    # the counts stay on disk, only the rows that are used get paged in
+    # the spare columns past the last date are left out
+    days = len(dates)
+    counts = np.load(cache_path(file, '.npy', folder),
+                     mmap_mode='r')[:, :days]
+    new = np.load(cache_path(file, '.new.npy', folder),
+                  mmap_mode='r')[:, :days]
+
+    # caches written before the totals were kept are summed once here
+    top = region_columns(meta)[0]
+    if levels is None:
+        totals = sum_regions(counts, meta[top])
+        levels, groups = aggregate(totals), totals.index
+    groups = pd.Index(groups, name=top)
+    return Cube(meta, dates, counts, new, region_rows(meta),
+                pd.DataFrame(levels['totals'], groups, dates),
+                pd.DataFrame(levels['totals_new'], groups, dates),
+                pd.Series(levels['nation'], dates),
+                pd.Series(levels['nation_new'], dates))
+
+
+# loaded caches, keyed by file name: the region metadata, the date axis,
+# the memory mapped cumulative and new counts (region x date), the region
+# lookup, the cumulative and new counts of every state or country (state x
+# date) and the cumulative and new counts of the whole nation (date)
+Cube = collections.namedtuple('Cube', ['meta', 'dates', 'counts', 'new',
+                                       'rows', 'totals', 'totals_new',
+                                       'nation', 'nation_new'])
+_cubes = {}
+
+
+def load_cube(file):
+    if file in _cubes:
+        return _cubes[file]
+
+    # bring the cache up to date first if the csv is newer
+    if not cache_fresh(file):
+        ingest_file(file)
+
+    with stage(f'load {file}'):
+        _cubes[file] = clean_cube(read_cube(file))
+    return _cubes[file]
+
+
+def county_series(state, county, mode='cases', kind='confirmed'):
+    # cumulative or new counts for one county, read from its row of the cube
+    cube = load_cube(files[2] if mode == 'deaths' else files[0])
+    row = cube.rows['name'][(state, county)]
+    counts = cube.new if kind == 'new' else cube.counts
+    return pd.Series(counts[row], index=cube.dates)
+
+
+def state_totals(mode='cases', kind='confirmed'):
+    # cumulative or new counts of every state, with a row per state and a
+    # column per date, summed when the file was read
+    cube = load_cube(files[2] if mode == 'deaths' else files[0])
+    return cube.totals_new if kind == 'new' else cube.totals
+
+
+def nation_series(mode='cases', kind='confirmed'):
+    # cumulative or new counts of the whole US, summed when the file was read
+    cube = load_cube(files[2] if mode == 'deaths' else files[0])
+    return cube.nation_new if kind == 'new' else cube.nation
+
+
+def state_counties(state, mode='cases', kind='confirmed'):
+    # cumulative or new counts of the counties in a state, with a row per
+    # county and a column per date, read from just their rows of the cube
+    cube = load_cube(files[2] if mode == 'deaths' else files[0])
+    rows = cube.rows['members'][state]
+    counts = cube.new if kind == 'new' else cube.counts
+    return pd.DataFrame(counts[rows], index=cube.meta['Admin2'].iloc[rows],
+                        columns=cube.dates)
+
+
+def province_series(country, province, mode='cases', kind='confirmed'):
+    # cumulative or new counts for one province of the global files
+    cube = load_cube(files[3] if mode == 'deaths' else files[1])
+    row = cube.rows['name'][(country, province)]
+    counts = cube.new if kind == 'new' else cube.counts
+    return pd.Series(counts[row], index=cube.dates)
+
+
+# per country totals of the global files, keyed by file name
+_countries = {}
+
+
+@profiled
+def country_totals(mode='cases'):
+    # cumulative and new counts for every country, with a row per day and a
+    # column per country, from the totals summed when the file was read
+    # and their new counts computed along with them
+    file = files[3] if mode == 'deaths' else files[1]
+    if file not in _countries:
+        cube = load_cube(file)
+        _countries[file] = (cube.totals.transpose(),
+                            cube.totals_new.transpose())
+    return _countries[file]
+
+
+# two letter codes of the US states and territories, and other names of
+# countries, accepted wherever a state or country is asked for
+STATE_CODES = {
+    'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas',
+    'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut',
+    'DE': 'Delaware', 'DC': 'District of Columbia', 'FL': 'Florida',
+    'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois',
+    'IN': 'Indiana', 'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky',
+    'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland',
+    'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota',
+    'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana',
+    'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire',
+    'NJ': 'New Jersey', 'NM': 'New Mexico', 'NY': 'New York',
+    'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio',
+    'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania',
+    'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota',
+    'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont',
+    'VA': 'Virginia', 'WA': 'Washington', 'WV': 'West Virginia',
+    'WI': 'Wisconsin', 'WY': 'Wyoming', 'AS': 'American Samoa',
+    'GU': 'Guam', 'MP': 'Northern Mariana Islands', 'PR': 'Puerto Rico',
+    'VI': 'Virgin Islands'}
+COUNTRY_ALIASES = {
+    'USA': 'US', 'United States': 'US', 'UK': 'United Kingdom',
+    'South Korea': 'Korea, South', 'North Korea': 'Korea, North',
+    'Czech Republic': 'Czechia', 'Ivory Coast': "Cote d'Ivoire",
+    'Myanmar': 'Burma', 'Taiwan': 'Taiwan*',
+    'Vatican': 'Holy See'}
+
+# county name endings that are left out as often as not
+COUNTY_SUFFIXES = ['county', 'parish', 'borough', 'censusarea']
+
+
+def normalize(name):
+    # key a name is looked up by, case, accents, punctuation and spaces
+    # don't matter, so 'Mc Dowell' is 'McDowell' and 'Saint' is 'St.'
+    name = unicodedata.normalize('NFKD', str(name)).lower()
+    name = re.sub(r'\bsaint\b', 'st', name.replace('&', 'and'))
+    return re.sub(r'[^a-z0-9]', '', name)
+
+
+def trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class RegionIndex:
+    # every state, county, country and province by its normalized name, for
+    # resolving what was typed without touching the data
+    # names are grouped by what they are in: (scope, None) holds the states
+    # or countries of 'us' or 'global', (scope, state) a state's counties
+    # fips maps FIPS codes to (scope, state, county), county None for states
+    def __init__(self, groups, fips, aliases):
+        self.names, self.keys, self.grams = {}, {}, {}
+        for group, names in groups.items():
+            table = self.names[group] = {}
+            for name in names:
+                table.setdefault(normalize(name), name)
+            # sorted for prefix search, and by trigram for fuzzy search
+            self.keys[group] = sorted(table)
+            grams = collections.defaultdict(list)
+            for key in self.keys[group]:
+                for gram in trigrams(key):
+                    grams[gram].append(key)
+            self.grams[group] = dict(grams)
+        for group, alias in aliases.items():
+            for text, name in alias.items():
+                if name in self.names.get(group, {}).values():
+                    self.names[group].setdefault(normalize(text), name)
+        self.fips = fips
+
+    def lookup(self, text, group):
+        # the name text stands for, or None
+        table = self.names.get(group, {})
+        key = normalize(text)
+        if key in table:
+            return table[key]
+        for suffix in COUNTY_SUFFIXES:
+            if key.endswith(suffix) and key[:-len(suffix)] in table:
+                return table[key[:-len(suffix)]]
+        code = str(text).strip()
+        if code.isdigit() and int(code) in self.fips:
+            scope, state, county = self.fips[int(code)]
+            if group == (scope, state if county else None):
+                return county or state
+        return None
+
+    def suggest(self, text, group, n=5):
+        # names starting with text first, then the names sharing the most
+        # trigrams with it
+        key = normalize(text)
+        keys = self.keys.get(group, [])
+        found = []
+        i = bisect.bisect_left(keys, key)
+        while key and i < len(keys) and keys[i].startswith(key) and \
+                len(found) < n:
+            found.append(keys[i])
+            i += 1
+        grams = trigrams(key)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self.grams.get(group, {}).get(gram, []))
+        score = {k: c / (len(grams) + len(trigrams(k)) - c)
+                 for k, c in shared.items()}
+        for k in sorted(score, key=lambda k: (-score[k], k)):
+            if len(found) >= n or score[k] < 0.2:
+                break
+            if k not in found:
+                found.append(k)
+        return [self.names[group][k] for k in found]
+
+    def resolve(self, text, group):
+        # like lookup(), but a name that isn't found is an error naming the
+        # closest ones
+        name = self.lookup(text, group)
+        if name is None:
+            close = self.suggest(text, group)
+            hint = f" Did you mean {', '.join(close)}?" if close else ''
+            raise LookupError(f'{text} not recognized!{hint}')
+        return name
+
+
+def build_regions(cubes=None):
+    # from the cubes of the US and global confirmed files by scope, the
+    # loaded ones by default
+    cubes = cubes or {'us': load_cube(files[0]),
+                      'global': load_cube(files[1])}
+    groups, fips = {}, {}
+    for scope, cube in cubes.items():
+        groups[(scope, None)] = list(cube.rows['members'])
+        for top, sub in cube.rows['name']:
+            if isinstance(sub, str):
+                groups.setdefault((scope, top), []).append(sub)
+
+    # counties by their five digit FIPS code, states by the first two
+    # digits, codes from 80000 up are the out of state and unassigned rows
+    meta = cubes['us'].meta if 'us' in cubes else pd.DataFrame()
+    rows = cubes['us'].rows['fips'] if 'us' in cubes else {}
+    for code, row in rows.items():
+        state, county = meta['Province_State'][row], meta['Admin2'][row]
+        if not isinstance(county, str):
+            fips.setdefault(code, ('us', state, None))
+            continue
+        fips[code] = ('us', state, county)
+        if code < 80000:
+            fips.setdefault(code // 1000, ('us', state, None))
+    return RegionIndex(groups, fips, {('us', None): STATE_CODES,
+                                      ('global', None): COUNTRY_ALIASES})
+
+
+# region index of the current data, see region_index()
+_regions = None
+
+
+def region_index():
+    # built once per data version and kept in input/regions/ for later runs
+    # only its attributes are pickled, so it loads from any entry point
+    global _regions
+    if _regions is None:
+        folder = f'{DIR_PATH}/input/regions'
+        path = f'{folder}/{data_version()}.pickle'
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            _regions = RegionIndex.__new__(RegionIndex)
+            vars(_regions).update(state)
+        except FileNotFoundError:
+            _regions = build_regions()
+            os.makedirs(folder, exist_ok=True)
+            part = f'{path}.{os.getpid()}.part'
+            with open(part, 'wb') as f:
+                pickle.dump(vars(_regions), f)
+            os.replace(part, path)
+
+            # other runs may still be using the indexes of other versions, so
+            # only those older than this version's data are dropped, and
+            # files left behind by runs that died more than a day ago
+            built = os.stat(data_dir()).st_mtime
+            for entry in os.scandir(folder):
+                with contextlib.suppress(FileNotFoundError):
+                    age = entry.stat().st_mtime
+                    if entry.name.endswith('.pickle') and \
+                            entry.path != path and age < built or \
+                            entry.name.endswith('.part') and \
+                            time.time() - age > 86400:
+                        os.remove(entry.path)
+    return _regions
+
+
+def ask(prompt, group):
+    # keep asking until the answer names a region
+    regions = region_index()
+    while True:
+        try:
+            return regions.resolve(input(prompt), group)
+        except LookupError as e:
+            print(e)
+
+
+def clear_datasets():
+    # forget loaded files so the next plot reads freshly downloaded data
+    global _version, _pinned, _regions
+    _cubes.clear()
+    _countries.clear()
+    _metrics.clear()
+    _version = None
+    _pinned = None
+    _regions = None
+    results.invalidate()
+
+
+# hash of the current data, see data_version()
+_version = None
+
+
+def data_version():
+    # short hash of the downloaded files' contents, which changes whenever
+    # any of them does
+    global _version
+    if _version is None:
+        _version = content_version(read_validators(data_dir()))
+        # redistributed counts are different data
+        if REDISTRIBUTE:
+            _version += '-redistributed'
+    return _version
+
+
+def content_version(validators, folder=None):
+    digest = hashlib.sha256()
+    for file in files:
+        sha = (validators.get(file) or {}).get('sha256')
+        if sha is None:
+            # files that were never downloaded here go by their cache
+            cache = cache_path(file, '.npz', folder)
+            sha = os.path.exists(cache) and os.stat(cache).st_mtime_ns
+        digest.update(f'{file}:{sha}\n'.encode())
+    return digest.hexdigest()[:16]
+
+
+def result_size(value):
+    # rough size of a cached result in bytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(result_size(item) for item in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    # least recently used results, bounded by their total size in bytes
+    # keys are paired with the data version, so results of old data are
+    # never returned, and folder optionally keeps every result on disk too,
+    # in a subfolder per data version
+    def __init__(self, max_bytes=256 << 20, folder=None):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute, version=None):
+        # return the cached result for key, calling compute() on a miss
+        key = (version or data_version(), key)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key][0]
+
+        path = self.disk_path(key)
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            with self.lock:
+                self.stats['disk_hits'] += 1
+        else:
+            value = compute()
+            with self.lock:
+                self.stats['misses'] += 1
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+                    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(f'{path}.{os.getpid()}.tmp', path)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        # results bigger than the whole cache are only kept on disk
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.stats['evictions'] += 1
+
+    def disk_path(self, key):
+        if not self.folder:
+            return None
+        name = hashlib.sha1(repr(key[1]).encode()).hexdigest()
+        return os.path.join(self.folder, key[0], f'{name}.pkl')
+
+    def invalidate(self):
+        # new data arrived, drop everything computed from the old data
+        with self.lock:
+            self.stats['invalidations'] += 1
+            self.entries.clear()
+            self.bytes = 0
+        if self.folder and os.path.isdir(self.folder):
+            current = data_version()
+            for version in os.listdir(self.folder):
+                if version != current:
+                    shutil.rmtree(os.path.join(self.folder, version),
+                                  ignore_errors=True)
+
+    def summary(self):
+        with self.lock:
+            return {**self.stats, 'entries': len(self.entries),
+                    'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+
+# rendered pages and query answers, see set_cache_options()
+results = ResultCache()
+
+
+def set_cache_options(max_bytes=256 << 20, disk=False):
+    # size of the in-memory result cache and whether results are also
+    # kept on disk in input/cache/ between runs
+    global results
+    folder = os.path.join(DIR_PATH, 'input', 'cache') if disk else None
+    results = ResultCache(max_bytes, folder)
+
+
+def _fill_runs(new):
+    # one pass of the zero filling over every column of a days x regions
+    # block, a run of zeros followed by a nonzero day is replaced by the
+    # average of that day's count, spread over the run and the day itself
+    # also returns, per column, the first day the pass can't settle (or -1)
+    days = new.shape[0]
+    day = np.arange(days)[:, np.newaxis]
+
+    # for every day, find the next day that had new cases (days if none)
+    # and the last day up to it that had new cases (-1 if none)
+    nonzero = new != 0
+    nxt = np.where(nonzero, day, days)
+    nxt = np.minimum.accumulate(nxt[::-1], axis=0)[::-1]
+    prv = np.maximum.accumulate(np.where(nonzero, day, -1), axis=0)
+
+    # zeros followed by a nonzero day get that day's count spread over them
+    # trailing zeros are left alone since there is nothing to spread yet
+    gap = ~nonzero & (nxt < days)
+    end = np.minimum(nxt, days - 1)
+    total = np.take_along_axis(new, end, axis=0)
+    length = end - (prv + 1)
+    # a positive count only covers as many zeros as it can give at least one
+    # case each, the zeros in front of that stay zero
+    length = np.where(total > 0, np.minimum(length, total - 1), length)
+    mean = total // np.maximum(length + 1, 1)
+
+    # fill in the zeros with the average
+    out = new.copy()
+    fill = gap & (end - day <= length)
+    out[fill] = mean[fill]
+
+    # the nonzero day keeps whatever is left over after the average
+    last = gap[:-1] & nonzero[1:]
+    out[1:][last] = new[1:][last] - (mean[:-1] * length[:-1])[last]
+
+    # a negative count can leave nothing over, turning that day into a zero
+    # that starts a new run with the zeros after it
+    stuck = np.zeros_like(gap)
+    stuck[1:] = last & (out[1:] == 0) & (day[1:] < days - 1)
+    first = np.where(stuck.any(axis=0), stuck.argmax(axis=0), -1)
+    return out, first
+
+
+@profiled
+def fill_gaps(new, start=None):
+    # fill in zeros with averages of next day's data for a block of new
+    # cases with a row per day and a column per region
+    # days before a region's start are already settled and left untouched
+    out = np.array(new, dtype='int64')
+    if len(out):
+        day = np.arange(len(out))[:, np.newaxis]
+        cols = np.arange(out.shape[1])
+        if start is None:
+            start = np.full(out.shape[1], -1)
+        # regions whose pass got stuck are redone from the stuck day onwards,
+        # with everything before it settled and the rest as it was
+        while cols.size:
+            block = np.where(day < start, 1, out[:, cols])
+            block, first = _fill_runs(block)
+            done = (day >= start) & ((day <= first) | (first < 0))
+            out[:, cols] = np.where(done, block, out[:, cols])
+            cols, start = cols[first >= 0], first[first >= 0]
+    return out
+
+
+@profiled
+def daily_new(confirmed):
+    # cumulative counts with a row per day and a column per region
+    confirmed = np.asarray(confirmed, dtype='int64')
+    single = confirmed.ndim == 1
+    if single:
+        confirmed = confirmed[:, np.newaxis]
+
+    # to get the number of new cases each day
+    # subtract yesterday's confirmed cases from today's confirmed cases
+    new = fill_gaps(np.diff(confirmed, axis=0, prepend=0))
+    return new[:, 0] if single else new
+
+
+# a day's new count is a spike, a backlog reported at once, when it is at
+# least SPIKE_MIN and over SPIKE_FACTOR times the average of the SPIKE_DAYS
+# days before it
+SPIKE_DAYS = 14
+SPIKE_FACTOR = 10
+SPIKE_MIN = 50
+
+# days before a negative count or a spike that it is spread back over
+SPREAD_DAYS = 28
+
+# whether negative counts and spikes are spread back, see clean_cube()
+REDISTRIBUTE = False
+
+
+def set_quality_options(redistribute=False):
+    global REDISTRIBUTE
+    REDISTRIBUTE = redistribute
+    clear_datasets()
+
+
+def trailing_mean(new, days):
+    # mean of up to this many days before each day, not counting the day
+    # itself, for a block with a row per region and a column per day
+    # nan on the first day, which has none before it
+    sums = np.zeros((len(new), new.shape[1] + 1))
+    np.cumsum(new, axis=1, out=sums[:, 1:])
+    end = np.arange(new.shape[1])
+    start = np.maximum(end - days, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[:, end] - sums[:, start]) / (end - start)
+
+
+def find_anomalies(new):
+    # negative days and spikes in a block of new counts, a row per region
+    new = np.asarray(new, dtype='float64')
+    baseline = trailing_mean(np.maximum(new, 0), SPIKE_DAYS)
+    with np.errstate(invalid='ignore'):
+        spike = (new >= SPIKE_MIN) & (baseline > 0) & \
+            (new > SPIKE_FACTOR * baseline)
+    return new < 0, spike, baseline
+
+
+def reporting_gaps(counts):
+    # days a region's total didn't move between its first case and its
+    # last change, and the longest run of them, for a block of cumulative
+    # counts with a row per region
+    counts = np.asarray(counts, dtype='int64')
+    day = np.arange(counts.shape[1])
+    moved = np.diff(counts, axis=1, prepend=0) != 0
+    first = np.where(moved.any(axis=1), moved.argmax(axis=1), len(day))
+    last = len(day) - 1 - moved[:, ::-1].argmax(axis=1)
+    gap = ~moved & (day > first[:, np.newaxis]) & \
+        (day < last[:, np.newaxis])
+    # a day's run length is its distance from the last day that wasn't a gap
+    settled = np.maximum.accumulate(np.where(gap, -1, day), axis=1)
+    run = np.where(gap, day - settled, 0)
+    return gap.sum(axis=1), run.max(axis=1, initial=0)
+
+
+def spread_back(new, rows, days, amounts):
+    # move each amount off its day onto the SPREAD_DAYS days before it, in
+    # proportion to their counts, or evenly where they are all zero
+    # a negative amount is only taken back as far as those days have it
+    window = np.arange(1, SPREAD_DAYS + 1)
+    cols = days[:, np.newaxis] - window
+    valid = cols >= 0
+    cols = np.maximum(cols, 0)
+    weights = np.where(valid, np.maximum(new[rows[:, np.newaxis], cols], 0),
+                       0)
+    total = weights.sum(axis=1)
+    even = valid / np.maximum(valid.sum(axis=1), 1)[:, np.newaxis]
+    share = np.where(total[:, np.newaxis] > 0,
+                     weights / np.maximum(total, 1e-12)[:, np.newaxis], even)
+    amounts = np.where(valid.any(axis=1), np.maximum(amounts, -total), 0)
+    # bincount adds up the moves that land on the same day
+    cells = np.concatenate([(rows[:, np.newaxis] * new.shape[1] + cols)
+                            .ravel(), rows * new.shape[1] + days])
+    moved = np.concatenate([(share * amounts[:, np.newaxis]).ravel(),
+                            -amounts])
+    new += np.bincount(cells, moved, minlength=new.size).reshape(new.shape)
+    return new
+
+
+@profiled
+def redistribute(new):
+    # new counts with negative days taken back from the days before them,
+    # and spikes cut down to their baseline with the rest spread back, for
+    # a block with a row per region and a column per day
+    # every region keeps its total, and the counts are rounded through the
+    # running totals so they stay whole numbers
+    new = np.array(new, dtype='float64', ndmin=2)
+    negative, spike, baseline = find_anomalies(new)
+    rows, days = np.nonzero(negative | spike)
+    amounts = np.where(negative[rows, days], new[rows, days],
+                       new[rows, days] - baseline[rows, days])
+    new = spread_back(new, rows, days, amounts)
+    totals = np.rint(np.cumsum(new, axis=1))
+
+    # what negative days the spreading couldn't take back, where they
+    # overlap, comes off the days just before them, so the running totals
+    # never drop
+    totals = np.minimum.accumulate(totals[:, ::-1], axis=1)[:, ::-1]
+    return np.diff(totals, axis=1, prepend=0).astype('int32')
+
+
+def clean_cube(cube):
+    # the cube with its new counts redistributed, when that is turned on
+    if not REDISTRIBUTE:
+        return cube
+    with stage('redistribute'):
+        return cube._replace(
+            new=redistribute(cube.new),
+            totals_new=pd.DataFrame(redistribute(cube.totals_new),
+                                    cube.totals_new.index,
+                                    cube.totals_new.columns),
+            nation_new=pd.Series(redistribute(cube.nation_new)[0],
+                                 cube.nation_new.index))
+
+
+@profiled
+def anomaly_report(file):
+    # every region of a file with negative days, spikes or reporting gaps
+    # in the counts as downloaded: how many days of each, the cases taken
+    # off negative days, the cases over the baseline on spike days, and
+    # the longest gap
+    cube = load_cube(file)
+    if REDISTRIBUTE:
+        cube = read_cube(file)
+    negative, spike, baseline = find_anomalies(cube.new)
+    new = np.asarray(cube.new, dtype='float64')
+    gap_days, longest_gap = reporting_gaps(cube.counts)
+    report = cube.meta[region_columns(cube.meta)].copy()
+    report['negative_days'] = negative.sum(axis=1)
+    report['negative_total'] = np.where(negative, new, 0).sum(axis=1) \
+        .astype('int64')
+    report['spike_days'] = spike.sum(axis=1)
+    report['spike_excess'] = np.rint(np.where(
+        spike, new - baseline, 0).sum(axis=1)).astype('int64')
+    report['gap_days'] = gap_days
+    report['longest_gap'] = longest_gap
+    flagged = report[['negative_days', 'spike_days', 'gap_days']].any(axis=1)
+    return report[flagged].reset_index(drop=True)
+
+
+def rolling_mean(new, days):
+    # trailing mean over days for every region at once, from a running sum
+    # days before the first full window have no mean, nor does a series
+    # shorter than the window
+    total = np.cumsum(new, axis=1, dtype='float64')
+    out = np.full(total.shape, np.nan)
+    if total.shape[1] >= days:
+        out[:, days - 1] = total[:, days - 1] / days
+        out[:, days:] = (total[:, days:] - total[:, :-days]) / days
+    return out
+
+
+def week_over_week(new):
+    # new cases in the last 7 days over the 7 days before, minus one
+    week = rolling_mean(new, 7)
+    out = np.full(week.shape, np.nan)
+    if week.shape[1] > 7:
+        out[:, 7:] = week[:, 7:] / np.where(week[:, :-7] > 0, week[:, :-7],
+                                            np.nan) - 1
+    return out
+
+
+def doubling_time(confirmed):
+    # days the cumulative count would take to double at last week's growth
+    confirmed = np.asarray(confirmed, dtype='float64')
+    out = np.full(confirmed.shape, np.nan)
+    if confirmed.shape[1] > 7:
+        ratio = confirmed[:, 7:] / np.where(confirmed[:, :-7] > 0,
+                                            confirmed[:, :-7], np.nan)
+        out[:, 7:] = 7 * np.log(2) / np.log(np.where(ratio > 1, ratio,
+                                                     np.nan))
+    return out
+
+
+def per_100k(values, population):
+    population = np.where(population > 0, population, np.nan)
+    return values * 1e5 / population[:, np.newaxis]
+
+
+# derived series, each computed for every region at once from the
+# cumulative and new counts (region x date) and each region's population
+# the title of each is filled in with the mode
+METRICS = {
+    'avg7': ("7-Day Average of New COVID-19 {Mode}",
+             lambda confirmed, new, population: rolling_mean(new, 7)),
+    'avg14': ("14-Day Average of New COVID-19 {Mode}",
+              lambda confirmed, new, population: rolling_mean(new, 14)),
+    'per100k': ("Total Confirmed COVID-19 {Mode} per 100k People",
+                lambda confirmed, new, population:
+                per_100k(confirmed, population)),
+    'new_per100k': ("7-Day Average of New COVID-19 {Mode} per 100k People",
+                    lambda confirmed, new, population:
+                    per_100k(rolling_mean(new, 7), population)),
+    'growth': ("Week over Week Growth of New COVID-19 {Mode}",
+               lambda confirmed, new, population: week_over_week(new)),
+    'doubling': ("Doubling Time in Days of COVID-19 {Mode}",
+                 lambda confirmed, new, population:
+                 doubling_time(confirmed)),
+}
+
+
+def compute_metric(metric, confirmed, new, population):
+    # missing or zero counts and populations leave gaps, not errors
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return METRICS[metric][1](confirmed, new, population) \
+            .astype('float32')
+
+
+def region_population(file):
+    # population of every region of a file, nan where it isn't known
+    # only the US deaths file has a Population column, the US confirmed
+    # file takes it from there by UID
+    cube = load_cube(file)
+    if 'Population' in cube.meta:
+        return cube.meta['Population'].to_numpy(dtype='float64')
+    if file == files[0]:
+        deaths = load_cube(files[2]).meta
+        population = dict(zip(deaths['UID'], deaths['Population']))
+        return cube.meta['UID'].map(population).to_numpy(dtype='float64')
+    return np.full(len(cube.meta), np.nan)
+
+
+# derived series, keyed by file name, metric and level, computed on first
+# use and kept with the cubes
+_metrics = {}
+
+
+@profiled
+def derived(file, metric, level='regions'):
+    # one metric for every region of a file, for every state or country of
+    # it (level 'totals') or for the nation (level 'nation', one row), with
+    # a row per region and a column per date
+    if (file, metric, level) not in _metrics:
+        cube = load_cube(file)
+        population = region_population(file)
+        if level == 'regions':
+            confirmed, new = np.asarray(cube.counts), np.asarray(cube.new)
+        elif level == 'totals':
+            top = np.asarray(cube.meta[region_columns(cube.meta)[0]], object)
+            population = pd.Series(population).groupby(top).sum(min_count=1) \
+                .reindex(cube.totals.index).to_numpy()
+            confirmed = cube.totals.to_numpy()
+            new = cube.totals_new.to_numpy()
+        else:
+            population = np.array([pd.Series(population).sum(min_count=1)])
+            confirmed = cube.nation.to_numpy()[np.newaxis, :]
+            new = cube.nation_new.to_numpy()[np.newaxis, :]
+        _metrics[(file, metric, level)] = compute_metric(
+            metric, confirmed, new, population)
+    return _metrics[(file, metric, level)]
+
+
+# title and output file of every page, filled in with the mode and region
+PAGES = {
+    'conf_county': ("Total Confirmed COVID-19 {Mode} in {county} County",
+                    'conf_{mode}_{county}'),
+    'new_county': ("New COVID-19 {Mode} in {county} County",
+                   'new_{mode}_{county}'),
+    'conf_state': ("Total Confirmed COVID-19 {Mode} in {state}",
+                   'conf_{mode}_{state}'),
+    'new_state': ("New COVID-19 {Mode} in {state}",
+                  'new_{mode}_{state}'),
+    'conf_by_county': ("Total Confirmed COVID-19 {Mode} in {state} by County",
+                       'conf_{mode}_{state}_by_county'),
+    'new_by_county': ("New COVID-19 {Mode} in {state} by County",
+                      'new_{mode}_{state}_by_county'),
+    'conf_by_state': ("Total Confirmed COVID-19 {Mode} by State",
+                      'conf_{mode}_by_state'),
+    'new_by_state': ("New COVID-19 {Mode} by State",
+                     'new_{mode}_by_state'),
+    'conf_nation': ("Total Confirmed COVID-19 {Mode} in the US",
+                    'conf_{mode}_US'),
+    'new_nation': ("New COVID-19 {Mode} in the US", 'new_{mode}_US'),
+    'conf_country': ("Total Confirmed COVID-19 {Mode} in {country}",
+                     'conf_{mode}_{country}'),
+    'new_country': ("New COVID-19 {Mode} in {country}",
+                    'new_{mode}_{country}'),
+    'conf_province': ("Total Confirmed COVID-19 {Mode} in {province}, "
+                      "{country}", 'conf_{mode}_{country}_{province}'),
+    'new_province': ("New COVID-19 {Mode} in {province}, {country}",
+                     'new_{mode}_{country}_{province}'),
+    'conf_by_province': ("Total Confirmed COVID-19 {Mode} in {country} by "
+                         "Province/State",
+                         'conf_{mode}_{country}_by_province'),
+    'new_by_province': ("New COVID-19 {Mode} in {country} by Province/State",
+                        'new_{mode}_{country}_by_province'),
+    'conf_by_country': ("Total Confirmed COVID-19 {Mode} by Country",
+                        'conf_{mode}_by_country'),
+    'new_by_country': ("New COVID-19 {Mode} by Country",
+                       'new_{mode}_by_country'),
+}
+
+# every new page has a metric page too, titled with the metric's title
+for page, (title, name) in list(PAGES.items()):
+    if page.startswith('new_'):
+        PAGES[page.replace('new_', 'metric_', 1)] = (
+            title.replace("New COVID-19 {Mode}", "{Metric}"),
+            name.replace('new_', '{metric}_', 1))
+
+
+def set_html_options(plotlyjs='shared', precompress=False, webgl=False,
+                     max_points=None):
+    # how pages load plotly.js: 'shared' writes the bundle once to output/
+    # and links every page to it, 'embed' puts the whole bundle in each page
+    # precompress also writes a gzipped copy of every file for web servers
+    # that can send .gz files as they are
+    # webgl draws the traces of the by county/state pages with Scattergl and
+    # max_points caps how many points each of those traces keeps
+    global PLOTLYJS, PRECOMPRESS, WEBGL, MAX_POINTS
+    PLOTLYJS = plotlyjs
+    PRECOMPRESS = precompress
+    WEBGL = webgl
+    MAX_POINTS = max_points
+
+
+def decimate(y, points):
+    # shrink a days x traces block to about this many points per trace
+    # the lowest and highest day of every bucket of days are kept, so peaks
+    # and dips survive, along with the first and last day
+    # returns the kept days for every trace and their values
+    days = len(y)
+    buckets = max(1, (points - 2) // 2)
+    size = -(-days // buckets)
+
+    # pad the last bucket with the last day so every bucket is the same size
+    padded = np.concatenate([y, np.repeat(y[-1:], buckets * size - days, 0)])
+    padded = padded.reshape(buckets, size, -1)
+    offset = np.arange(buckets)[:, np.newaxis] * size
+    low = offset + padded.argmin(axis=1)
+    high = offset + padded.argmax(axis=1)
+
+    first = np.zeros((1, y.shape[1]), dtype=int)
+    last = np.full((1, y.shape[1]), days - 1)
+    keep = np.concatenate([first, low, high, last])
+    keep = np.sort(np.minimum(keep, days - 1), axis=0)
+    return keep, np.take_along_axis(y, keep, axis=0)
+
+
+@profiled
+def write_file(path, text):
+    # write through a temporary file so readers never see half a page
+    part = f'{path}.{os.getpid()}.part'
+    with open(part, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(part, path)
+    if PRECOMPRESS:
+        with open(part, 'wb') as f:
+            f.write(gzip.compress(text.encode('utf-8'), mtime=0))
+        os.replace(part, f'{path}.gz')
+
+
+def write_bytes(path, data):
+    # like write_file(), for binary files that are never gzipped again
+    part = f'{path}.{os.getpid()}.part'
+    with open(part, 'wb') as f:
+        f.write(data)
+    os.replace(part, path)
+
+
+def plotlyjs_path():
+    # the shared plotly.js bundle, written the first time a page needs it
+    path = os.path.join(DIR_PATH, 'output', 'plotly.min.js')
+    if not os.path.exists(path) or \
+            PRECOMPRESS and not os.path.exists(f'{path}.gz'):
+        write_file(path, plotly.offline.get_plotlyjs())
+    return path
+
+
+@profiled
+def make_figure(page, mode, x, y, names=None, **region):
+    # y is a single series, or a days x traces block when names are given
+    # region holds the state/county or country/province in the title
+    title, name = PAGES[page]
+    fields = {'mode': mode, 'Mode': mode.title(), **region}
+    if 'metric' in region:
+        fields['Metric'] = METRICS[region['metric']][0].format(**fields)
+
+    if names is None:
+        # a single line of the confirmed or new cases
+        fig = px.line(x=x, y=np.asarray(y))
     else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Population'],
-                     axis=1, errors='ignore')
-
-    # filter by state
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-
-    # filter by county
-    cvDF = cvDF.loc[cvDF['Admin2'] == county]
-
-    # drop everything but dates and cases
-    cvDF = cvDF.drop(['Admin2', 'Province_State'], axis=1)
-
-    # now that everything is dropped, we can transpose
-    # we will now have 2 columns:
-    # the 1st column is the index containing the date
-    # the 2nd column contains the total number of confirmed cases
-    cvDF = cvDF.transpose()
-
-    # name the unnamed column
-    # cvDF.columns allows us to rename all columns using a list of strings.
-    # there is technically only one column since date is an index
-    cvDF.columns = ['confirmed']
-
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
-
-    # plot the total number of confirmed cases
-    fig = px.line(x=cvDF.index, y=cvDF['confirmed'])
-    title = f"Total Confirmed COVID-19 {mode.title()} in {county} County"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/conf_{mode}_{county}.html')
+        # create a plot with a trace for each column, built all at once
+        # instead of adding the traces one at a time
+        y = np.asarray(y)
+        x = np.repeat(np.asarray(x)[:, np.newaxis], y.shape[1], axis=1)
+        if MAX_POINTS and len(y) > MAX_POINTS:
+            keep, y = decimate(y, MAX_POINTS)
+            x = np.take_along_axis(x, keep, axis=0)
+        scatter = go.Scattergl if WEBGL else go.Scatter
+        fig = go.Figure([scatter(x=x[:, i], y=y[:, i], name=col)
+                         for i, col in enumerate(names)])
+
+    # update the graph elements
+    yaxis = fields.get('Metric', f"Number of COVID-19 {mode.title()}")
+    fig.update_layout(title=title.format(**fields), xaxis_title="Date",
+                      yaxis_title=yaxis)
+    return fig
+
+
+def page_file(page, mode, folder='', **region):
+    # where a page goes, relative to output/
+    name = PAGES[page][1].format(mode=mode, **region)
+    return os.path.join(folder, name + '.html')
+
+
+def write_page(page, mode, x, y, names=None, folder='', show=False,
+               **region):
+    # build the page's figure, write it to output/ and show
+    path = os.path.join(DIR_PATH, 'output',
+                        page_file(page, mode, folder, **region))
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    if PLOTLYJS == 'embed':
+        include = True
+    else:
+        # link to the one shared copy of plotly.js in output/
+        include = os.path.relpath(plotlyjs_path(), folder)
+        include = include.replace(os.sep, '/')
+
+    # the same page of the same data renders to the same html, so only
+    # build the figure when it isn't cached or has to be shown
+    fig = make_figure(page, mode, x, y, names, **region) if show else None
+    key = ('page', page, mode, tuple(sorted(region.items())), include,
+           WEBGL, MAX_POINTS)
+    def render():
+        built = fig or make_figure(page, mode, x, y, names, **region)
+        with stage('to_html'):
+            return built.to_html(include_plotlyjs=include)
+
+    html = results.get(key, render)
+    write_file(path, html)
     if show:
         fig.show()
+    return path
 
 
-def new_county(state, county, mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Population'],
-                     axis=1, errors='ignore')
-
-    # filter by state
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-
-    # filter by county
-    cvDF = cvDF.loc[cvDF['Admin2'] == county]
+@profiled
+def confirmed_county(state, county, mode='cases', show=True):
+    # read the county's row of cumulative counts, indexed by date
+    cvDF = county_series(state, county, mode).to_frame('confirmed')
 
-    # drop everything but dates and cases
-    cvDF = cvDF.drop(['Admin2', 'Province_State'], axis=1)
+    # plot the total number of confirmed cases
+    write_page('conf_county', mode, cvDF.index, cvDF['confirmed'],
+               state=state, county=county, show=show)
 
-    # now that everything is dropped, we can transpose
-    # we will now have 2 columns:
-    # the 1st column is the index containing the date
-    # the 2nd column contains the total number of new cases
-    cvDF = cvDF.transpose()
 
-    # name the unnamed column
-    # cvDF.columns allows us to rename all columns using a list of strings.
-    # there is technically only one column since date is an index
-    cvDF.columns = ['confirmed']
-
-    # create new column for the number of new cases
-    cvDF['new'] = 0
-
-    # loop to compute number of new cases each day
-    prev = 0  # previous day's num of confirmed cases
-    # iterate through every row (rows correspond to days)
-    for index, row in cvDF.iterrows():
-        # to get the number of new cases that day
-        # subtract yesterday's confirmed cases from today's confirmed cases
-        cvDF.loc[index, 'new'] = cvDF.loc[index, 'confirmed'] - prev
-        # store this index's num of cases for use next time through
-        prev = cvDF.loc[index, 'confirmed']
-
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
-
-    # convert to list to fill in zeros with averages of next day's data
-    new = cvDF['new'].tolist()
-    for idx, val in enumerate(new):
-        if val == 0:
-            for length, zero in enumerate(new[idx+1:]):
-                if zero != 0:
-                    break
-            length += 1
-            if idx+length >= len(new) and new[-1] == 0:
-                break
-            mean = new[idx+length] // (length+1)
-            new[idx+length] = new[idx+length] - mean * (length)
-            for i in range(length):
-                new[idx+i] = mean
-    cvDF = cvDF.assign(new=new)
+@profiled
+def new_county(state, county, mode='cases', show=True):
+    # read the county's row of new cases each day, indexed by date
+    # zeros are already filled in with averages of next day's data
+    cvDF = county_series(state, county, mode, 'new').to_frame('new')
 
     # plot the number of new cases
-    fig = px.line(x=cvDF.index, y=cvDF['new'])
-    title = f"New COVID-19 {mode.title()} in {county} County"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/new_{mode}_{county}.html')
-    if show:
-        fig.show()
+    write_page('new_county', mode, cvDF.index, cvDF['new'],
+               state=state, county=county, show=show)
 
 
+@profiled
 def confirmed_state(state, mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Admin2', 'Population'],
-                     axis=1,  errors='ignore')
+    # totals of every state, summed over its counties when the file was
+    # read, with a row per state and a column per date
+    cvDF = state_totals(mode)
 
     # filter by state
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-
-    # group all entries (counties) in a state together
-    # sum all other columns
-    # when you group by state, it automatically makes state the index
-    cvDF = cvDF.groupby(['Province_State']).sum()
+    cvDF = cvDF.loc[[state]]
 
-    # now that everything is dropped, we can transpose
+    # now that everything is summed, we can transpose
     # we will now have 2 columns:
     # the 1st column is the index containing the date
     # the 2nd column contains the total number of confirmed cases
@@ -211,40 +1756,22 @@ def confirmed_state(state, mode='cases', show=True):
     # there is technically only one column since date is an index
     cvDF.columns = ['confirmed']
 
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
-
     # plot the total number of confirmed cases
-    fig = px.line(x=cvDF.index, y=cvDF['confirmed'])
-    title = f"Total Confirmed COVID-19 {mode.title()} in {state}"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/conf_{mode}_{state}.html')
-    if show:
-        fig.show()
+    write_page('conf_state', mode, cvDF.index, cvDF['confirmed'],
+               state=state, show=show)
 
 
+@profiled
 def new_state(state, mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Admin2', 'Population'],
-                     axis=1,  errors='ignore')
+    # new cases each day of every state, computed from the state totals
+    # when the file was read, with zeros filled in with averages of next
+    # day's data, with a row per state and a column per date
+    cvDF = state_totals(mode, 'new')
 
     # filter by state
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-
-    # group all entries (counties) in a state together
-    # sum all other columns
-    # when you group by state, it automatically makes state the index
-    cvDF = cvDF.groupby(['Province_State']).sum()
+    cvDF = cvDF.loc[[state]]
 
-    # now that everything is dropped, we can transpose
+    # now that everything is summed, we can transpose
     # we will now have 2 columns:
     # the 1st column is the index containing the date
     # the 2nd column contains the total number of new cases
@@ -253,315 +1780,1193 @@ def new_state(state, mode='cases', show=True):
     # name the unnamed column
     # cvDF.columns allows us to rename all columns using a list of strings.
     # there is technically only one column since date is an index
-    cvDF.columns = ['confirmed']
-
-    # create new column for the number of new cases
-    cvDF['new'] = 0
-
-    # loop to compute number of new cases each day
-    prev = 0  # previous day's num of confirmed cases
-    # iterate through every row (rows correspond to days)
-    for index, row in cvDF.iterrows():
-        # to get the number of new cases that day
-        # subtract yesterday's confirmed cases from today's confirmed cases
-        cvDF.loc[index, 'new'] = cvDF.loc[index, 'confirmed'] - prev
-        # store this index's num of cases for use next time through
-        prev = cvDF.loc[index, 'confirmed']
-
-    # convert to list to fill in zeros with averages of next day's data
-    new = cvDF['new'].tolist()
-    for idx, val in enumerate(new):
-        if val == 0:
-            for length, zero in enumerate(new[idx+1:]):
-                if zero != 0:
-                    break
-            length += 1
-            if idx+length >= len(new) and new[-1] == 0:
-                break
-            mean = new[idx+length] // (length+1)
-            new[idx+length] = new[idx+length] - mean * (length)
-            for i in range(length):
-                new[idx+i] = mean
-    cvDF = cvDF.assign(new=new)
-
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
+    cvDF.columns = ['new']
 
-    # plot the total number of confirmed cases
-    fig = px.line(x=cvDF.index, y=cvDF['new'])
-    title = f"New COVID-19 {mode.title()} in {state}"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/new_{mode}_{state}.html')
-    if show:
-        fig.show()
+    # plot the number of new cases
+    write_page('new_state', mode, cvDF.index, cvDF['new'],
+               state=state, show=show)
 
 
+@profiled
 def confirmed_by_county(state, mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Population'],
-                     axis=1, errors='ignore')
-
-    # filter by state
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-
-    # need to make the county (Admin2) the index for transposing.
-    cvDF.index = cvDF['Admin2']
-    # drop state and county fields.
-    cvDF = cvDF.drop(['Province_State', 'Admin2'], axis=1)
+    # the state's counties, with a row per county and a column per date
+    cvDF = state_counties(state, mode)
 
-    # now that everything is dropped, we can transpose
+    # now that only the dates are left, we can transpose
     # we will now have 2 columns:
     # the 1st column is the index containing the date
     # the rest of the columns are number of confirmed cases by county.
     cvDF = cvDF.transpose()
     cvDF = cvDF.drop(['Unassigned'], axis=1)
 
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
-
-    # create a plot and add a trace for each year column
-    fig = go.Figure()
-    # for every column
-    for col in cvDF.columns:
-        fig = fig.add_trace(go.Scatter(x=cvDF.index, y=cvDF[col], name=col))
-
-    # update the graph elements and show
-    title = f"Total Confirmed COVID-19 {mode.title()} in {state} by County"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/conf_{mode}_{state}_by_county.html')
-    if show:
-        fig.show()
+    # plot a trace for each column
+    write_page('conf_by_county', mode, cvDF.index, cvDF, cvDF.columns,
+               state=state, show=show)
 
 
+@profiled
 def new_by_county(state, mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Population'],
-                     axis=1, errors='ignore')
-
-    # filter by state
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-
-    # need to make the county (Admin2) the index for transposing.
-    cvDF.index = cvDF['Admin2']
-    # drop state and county fields.
-    cvDF = cvDF.drop(['Province_State', 'Admin2'], axis=1)
+    # the state's counties, with a row per county and a column per date,
+    # holding the new cases each day with zeros filled in with averages of
+    # next day's data
+    cvDF = state_counties(state, mode, 'new')
 
-    # now that everything is dropped, we can transpose
+    # now that only the dates are left, we can transpose
     # we will now have 2 columns:
     # the 1st column is the index containing the date
-    # the 2nd column contains the total number of confirmed cases
+    # the rest of the columns are number of new cases by county.
     cvDF = cvDF.transpose()
     cvDF = cvDF.drop(['Unassigned'], axis=1)
 
-    # loop to compute number of new cases each day by county
-    for col in cvDF.columns:
-        prev = [0]  # previous day's num of confirmed cases
-        for index, row in cvDF.iterrows():
-            # store this index's num of cases for use next time through
-            prev.append(cvDF.loc[index, col])
-            # to get the number of new cases that day
-            # subtract yesterday's confirmed cases from today's confirmed cases
-            cvDF.loc[index, col] = prev[-1] - prev[-2]
-
-    # convert to list to fill in zeros with averages of next day's data
-    for col in cvDF.columns:
-        new = cvDF[col].tolist()
-        for idx, val in enumerate(new):
-            if val == 0:
-                for length, zero in enumerate(new[idx+1:]):
-                    if zero != 0:
-                        break
-                length += 1
-                if idx+length >= len(new) and new[-1] == 0:
-                    break
-                mean = new[idx+length] // (length+1)
-                new[idx+length] = new[idx+length] - mean * (length)
-                for i in range(length):
-                    new[idx+i] = mean
-        cvDF[col] = new
-
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
-
-    # create a plot and add a trace for each year column
-    fig = go.Figure()
-    # for every column
-    for col in cvDF.columns:
-        fig = fig.add_trace(go.Scatter(x=cvDF.index, y=cvDF[col], name=col))
-
-    # update the graph elements and show
-    title = f"New COVID-19 {mode.title()} in {state} by County"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/new_{mode}_{state}_by_county.html')
-    if show:
-        fig.show()
+    # plot a trace for each column
+    write_page('new_by_county', mode, cvDF.index, cvDF, cvDF.columns,
+               state=state, show=show)
 
 
+@profiled
 def confirmed_by_state(mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
+    # totals of every state, summed over its counties when the file was
+    # read, with a row per state and a column per date
+    cvDF = state_totals(mode)
+
+    # now that everything is summed, we can transpose
+    # we will now have 2 columns:
+    # the 1st column is the index containing the date
+    # the rest of the columns are number of confirmed cases by state.
+    cvDF = cvDF.transpose()
+
+    # plot a trace for each column
+    write_page('conf_by_state', mode, cvDF.index, cvDF, cvDF.columns,
+               show=show)
 
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Population'],
-                     axis=1, errors='ignore')
 
-    # group all entries (counties) in a state together
-    # sum all other columns
-    # when you group by state, it automatically makes state the index
-    cvDF = cvDF.groupby(['Province_State']).sum()
+@profiled
+def new_by_state(mode='cases', show=True):
+    # new cases each day of every state, computed from the state totals
+    # when the file was read, with zeros filled in with averages of next
+    # day's data, with a row per state and a column per date
+    cvDF = state_totals(mode, 'new')
 
-    # now that everything is dropped, we can transpose
+    # now that everything is summed, we can transpose
     # we will now have 2 columns:
     # the 1st column is the index containing the date
-    # the rest of the columns are number of confirmed cases by county.
+    # the rest of the columns are number of new cases by state.
     cvDF = cvDF.transpose()
 
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
+    # plot a trace for each column
+    write_page('new_by_state', mode, cvDF.index, cvDF, cvDF.columns,
+               show=show)
 
-    # create a plot and add a trace for each year column
-    fig = go.Figure()
-    # for every column
-    for col in cvDF.columns:
-        fig = fig.add_trace(go.Scatter(x=cvDF.index, y=cvDF[col], name=col))
 
-    # update the graph elements and show
-    title = f"Total Confirmed COVID-19 {mode.title()} by State"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/conf_{mode}_by_state.html')
-    if show:
-        fig.show()
+@profiled
+def confirmed_nation(mode='cases', show=True):
+    # cumulative counts of the whole US, summed when the file was read
+    cvDF = nation_series(mode).to_frame('confirmed')
 
+    # plot the total number of confirmed cases
+    write_page('conf_nation', mode, cvDF.index, cvDF['confirmed'],
+               show=show)
 
-def new_by_state(mode='cases', show=True):
-    # read in file
-    if mode == 'deaths':
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[2]}', encoding='utf-8')
-    else:
-        cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
 
-    # remove columns we don't care about
-    cvDF = cvDF.drop(['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Combined_Key',
-                      'Lat', 'Long_', 'Country_Region', 'Population'],
-                     axis=1, errors='ignore')
+@profiled
+def new_nation(mode='cases', show=True):
+    # new cases each day in the whole US, computed from its cumulative
+    # counts with zeros filled in with averages of next day's data
+    cvDF = nation_series(mode, 'new').to_frame('new')
 
-    # group all entries (counties) in a state together
-    # sum all other columns
-    # when you group by state, it automatically makes state the index
-    cvDF = cvDF.groupby(['Province_State']).sum()
+    # plot the number of new cases
+    write_page('new_nation', mode, cvDF.index, cvDF['new'], show=show)
+
+
+@profiled
+def metric_pages(metric, state, county, mode='cases', show=True):
+    # a derived metric (see METRICS) for the county, the state, every county
+    # in the state but the unassigned cases, every state and the nation
+    file = files[2] if mode == 'deaths' else files[0]
+    cube = load_cube(file)
+    values, totals = derived(file, metric), derived(file, metric, 'totals')
+    counties = cube.meta['Admin2'].to_numpy(dtype=object)
+
+    row = cube.rows['name'][(state, county)]
+    write_page('metric_county', mode, cube.dates, values[row],
+               metric=metric, state=state, county=county, show=show)
+    i = cube.totals.index.get_loc(state)
+    write_page('metric_state', mode, cube.dates, totals[i],
+               metric=metric, state=state, show=show)
+    rows = cube.rows['members'][state]
+    rows = rows[counties[rows] != 'Unassigned']
+    write_page('metric_by_county', mode, cube.dates, values[rows].transpose(),
+               list(counties[rows]), metric=metric, state=state, show=show)
+    write_page('metric_by_state', mode, cube.dates, totals.transpose(),
+               list(cube.totals.index), metric=metric, show=show)
+    write_page('metric_nation', mode, cube.dates,
+               derived(file, metric, 'nation')[0], metric=metric, show=show)
+
+
+@profiled
+def confirmed_country(country, mode='cases', show=True):
+    # totals for every country are summed once and shared
+    confirmed, new = country_totals(mode)
+
+    # plot the total number of confirmed cases
+    write_page('conf_country', mode, confirmed.index, confirmed[country],
+               folder='global', country=country, show=show)
 
-    # now that everything is dropped, we can transpose
-    # we will now have 2 columns:
-    # the 1st column is the index containing the date
-    # the rest of the columns are number of confirmed cases by county.
-    cvDF = cvDF.transpose()
 
-    # loop to compute number of new cases each day by county
-    for col in cvDF.columns:
-        prev = [0]  # previous day's num of confirmed cases
-        for index, row in cvDF.iterrows():
-            # store this index's num of cases for use next time through
-            prev.append(cvDF.loc[index, col])
-            # to get the number of new cases that day
-            # subtract yesterday's confirmed cases from today's confirmed cases
-            cvDF.loc[index, col] = prev[-1] - prev[-2]
-
-    # convert date to a special pandas "datetime" value so it recognizes it
-    cvDF.index = pd.to_datetime(cvDF.index, format='%m/%d/%y')
-
-    # convert to list to fill in zeros with averages of next day's data
-    for col in cvDF.columns:
-        new = cvDF[col].tolist()
-        for idx, val in enumerate(new):
-            if val == 0:
-                for length, zero in enumerate(new[idx+1:]):
-                    if zero != 0:
-                        break
-                length += 1
-                if idx+length >= len(new) and new[-1] == 0:
+@profiled
+def new_country(country, mode='cases', show=True):
+    # totals for every country are summed once and shared, along with the
+    # new cases each day with zeros filled in with averages of next day's data
+    confirmed, new = country_totals(mode)
+
+    # plot the number of new cases
+    write_page('new_country', mode, new.index, new[country],
+               folder='global', country=country, show=show)
+
+
+@profiled
+def confirmed_province(country, province, mode='cases', show=True):
+    # read the province's row of cumulative counts, indexed by date
+    cvDF = province_series(country, province, mode).to_frame('confirmed')
+
+    # plot the total number of confirmed cases
+    write_page('conf_province', mode, cvDF.index, cvDF['confirmed'],
+               folder='global', country=country, province=province,
+               show=show)
+
+
+@profiled
+def new_province(country, province, mode='cases', show=True):
+    # read the province's row of new cases each day, indexed by date
+    # zeros are already filled in with averages of next day's data
+    cvDF = province_series(country, province, mode, 'new').to_frame('new')
+
+    # plot the number of new cases
+    write_page('new_province', mode, cvDF.index, cvDF['new'],
+               folder='global', country=country, province=province,
+               show=show)
+
+
+def by_province(country, mode='cases', kind='confirmed'):
+    # frame with a row per day and a column per province of the country
+    # the row without a province is the rest of the country, named after it
+    cube = load_cube(files[3] if mode == 'deaths' else files[1])
+    rows = cube.rows['members'][country]
+    provinces = cube.meta['Province/State'].to_numpy(dtype=object)[rows]
+    names = [p if isinstance(p, str) else country for p in provinces]
+    counts = cube.new if kind == 'new' else cube.counts
+    return pd.DataFrame(counts[rows].transpose(), index=cube.dates,
+                        columns=names)
+
+
+@profiled
+def confirmed_by_province(country, mode='cases', show=True):
+    cvDF = by_province(country, mode)
+
+    # plot a trace for each column
+    write_page('conf_by_province', mode, cvDF.index, cvDF, cvDF.columns,
+               folder='global', country=country, show=show)
+
+
+@profiled
+def new_by_province(country, mode='cases', show=True):
+    cvDF = by_province(country, mode, 'new')
+
+    # plot a trace for each column
+    write_page('new_by_province', mode, cvDF.index, cvDF, cvDF.columns,
+               folder='global', country=country, show=show)
+
+
+@profiled
+def confirmed_by_country(mode='cases', show=True):
+    confirmed, new = country_totals(mode)
+
+    # plot a trace for each column
+    write_page('conf_by_country', mode, confirmed.index, confirmed,
+               confirmed.columns, folder='global', show=show)
+
+
+@profiled
+def new_by_country(mode='cases', show=True):
+    confirmed, new = country_totals(mode)
+
+    # plot a trace for each column
+    write_page('new_by_country', mode, new.index, new, new.columns,
+               folder='global', show=show)
+
+
+def init_worker(html_options, cache_folder, profile, folder, redistribute):
+    # batch workers render with the parent's html options, snapshot and
+    # data options, and share its disk cache if it has one, their own
+    # memory cache would go unused
+    global results, _pinned, REDISTRIBUTE
+    _pinned = folder
+    REDISTRIBUTE = redistribute
+    set_html_options(*html_options)
+    results = ResultCache(0, cache_folder)
+    set_profile(profile)
+
+
+def render(job):
+    # worker side of batch(), builds and writes one page
+    # while profiling, the page's stages are sent back along with it
+    path = write_page(**job)
+    if PROFILE is None:
+        return path, []
+    events = PROFILE[:]
+    PROFILE.clear()
+    return path, events
+
+
+def parse_targets(targets, cube=None):
+    # sort the targets into states and (state, county) pairs
+    # 'all' is every state and every county, a county can also be given by
+    # its FIPS code
+    # names are looked up in the loaded data, or in cube, a US file
+    if 'all' in targets:
+        cube = cube or load_cube(files[0])
+        return set(cube.meta['Province_State']), \
+            [key for key in cube.rows['name'] if isinstance(key[1], str)]
+
+    regions = build_regions({'us': cube}) if cube else region_index()
+    want_states, want_counties = set(), []
+    for target in targets:
+        county, _, state = target.rpartition(',')
+        code = target.strip()
+        try:
+            if code.isdigit() and int(code) in regions.fips:
+                _, state, county = regions.fips[int(code)]
+            else:
+                state = regions.resolve(state, ('us', None))
+                if county.strip():
+                    county = regions.resolve(county, ('us', state))
+        except LookupError as e:
+            print(e)
+            continue
+        want_states.add(state)
+        if county:
+            want_counties.append((state, county))
+    return want_states, want_counties
+
+
+def batch_jobs(want_states, want_counties, mode, cube=None):
+    # pages to build for one mode, each as the keyword arguments of write_page
+    # from the loaded data, or from cube
+    cube = cube or load_cube(files[2] if mode == 'deaths' else files[0])
+    counties = np.asarray(cube.meta['Admin2'], dtype=object)
+
+    # totals for every state and the nation, plus their new cases
+    totals = cube.totals
+    confirmed = totals.to_numpy().transpose()
+    new = cube.totals_new.to_numpy().transpose()
+    jobs = [dict(page='conf_by_state', mode=mode, x=cube.dates,
+                 y=confirmed, names=list(totals.index)),
+            dict(page='new_by_state', mode=mode, x=cube.dates,
+                 y=new, names=list(totals.index)),
+            dict(page='conf_nation', mode=mode, x=cube.dates,
+                 y=cube.nation.to_numpy()),
+            dict(page='new_nation', mode=mode, x=cube.dates,
+                 y=cube.nation_new.to_numpy())]
+
+    # state pages, with every county in the state but the unassigned cases
+    rows = cube.rows['members']
+    for i, state in enumerate(totals.index):
+        if state not in want_states:
+            continue
+        jobs.append(dict(page='conf_state', mode=mode, x=cube.dates,
+                         y=confirmed[:, i], state=state))
+        jobs.append(dict(page='new_state', mode=mode, x=cube.dates,
+                         y=new[:, i], state=state))
+        members = rows[state][counties[rows[state]] != 'Unassigned']
+        for page, block in [('conf_by_county', cube.counts),
+                            ('new_by_county', cube.new)]:
+            jobs.append(dict(page=page, mode=mode, x=cube.dates,
+                             y=block[members].transpose(),
+                             names=list(counties[members]), state=state))
+
+    # county pages, one folder per state since county names repeat
+    for state, county in want_counties:
+        row = cube.rows['name'][(state, county)]
+        for page, block in [('conf_county', cube.counts),
+                            ('new_county', cube.new)]:
+            jobs.append(dict(page=page, mode=mode, x=cube.dates,
+                             y=block[row], state=state, county=county,
+                             folder=state))
+    return jobs
+
+
+def render_jobs(jobs, workers=None):
+    # write the pages of batch_jobs() and return their paths
+    for folder in {job.get('folder', '') for job in jobs}:
+        os.makedirs(os.path.join(DIR_PATH, 'output', folder), exist_ok=True)
+    if PLOTLYJS == 'shared':
+        plotlyjs_path()
+
+    # figure building and html writing are spread over a process pool
+    # the workers get the same html options and disk cache as this process
+    options = (PLOTLYJS, PRECOMPRESS, WEBGL, MAX_POINTS)
+    paths = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(options, results.folder,
+                                       PROFILE is not None, data_dir(),
+                                       REDISTRIBUTE)) as pool:
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count()) * 4))
+        for path, events in pool.map(render, jobs, chunksize=chunksize):
+            paths.append(path)
+            if PROFILE is not None:
+                PROFILE.extend(events)
+    return paths
+
+
+def batch(targets=('all',), workers=None):
+    # build every page for the targets without any prompts
+    # targets are 'all', state names or 'County, State' pairs
+    started = time.perf_counter()
+    want_states, want_counties = parse_targets(targets)
+    jobs = batch_jobs(want_states, want_counties, 'cases') + \
+        batch_jobs(want_states, want_counties, 'deaths')
+    render_jobs(jobs, workers)
+
+    elapsed = time.perf_counter() - started
+    print(f"Wrote {len(jobs)} figures in {elapsed:.1f}s "
+          f"({len(jobs) / elapsed:.1f} figures/s)")
+    return len(jobs)
+
+
+async def pipeline(targets=('all',), url=None, workers=None, depth=None):
+    # download, ingest and render all at once, each file is ingested as soon
+    # as it lands and its pages are queued as soon as it is ingested
+    # at most depth pages wait for the renderers, so a fast download can't
+    # pile up every page in memory
+    # returns the changed files and the number of pages written
+    loop = asyncio.get_running_loop()
+    workers = workers or os.cpu_count()
+    ready = asyncio.Queue()
+    jobs = asyncio.Queue(maxsize=depth or 2 * workers)
+    written, failed = 0, []
+
+    # renders go to a process pool, without the result cache since its keys
+    # are for the data version before this download
+    options = (PLOTLYJS, PRECOMPRESS, WEBGL, MAX_POINTS)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(options, None, PROFILE is not None,
+                                       None, REDISTRIBUTE)) as pool:
+        # the workers are started before the download threads, forking
+        # while other threads run isn't safe
+        list(pool.map(abs, range(workers)))
+        if PLOTLYJS == 'shared':
+            plotlyjs_path()
+
+        async def renderer():
+            # after a failure the rest of the queue is only drained, so
+            # nothing waits on a full queue
+            nonlocal written
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    return
+                if failed:
+                    continue
+                try:
+                    _, events = await loop.run_in_executor(pool, render, job)
+                except Exception as e:
+                    failed.append(e)
+                    continue
+                written += 1
+                if PROFILE is not None:
+                    PROFILE.extend(events)
+
+        def landed(file, cube):
+            # called on the download threads
+            loop.call_soon_threadsafe(ready.put_nowait, (file, cube))
+
+        renderers = [asyncio.create_task(renderer())
+                     for _ in range(workers)]
+        download = loop.run_in_executor(None, download_files, url, landed)
+        download.add_done_callback(lambda _: ready.put_nowait(None))
+        try:
+            # the targets are looked up in the first US file to arrive
+            want = None
+            while True:
+                item = await ready.get()
+                if item is None:
                     break
-                mean = new[idx+length] // (length+1)
-                new[idx+length] = new[idx+length] - mean * (length)
-                for i in range(length):
-                    new[idx+i] = mean
-        cvDF[col] = new
-
-    # create a plot and add a trace for each year column
-    fig = go.Figure()
-    # for every column
-    for col in cvDF.columns:
-        fig = fig.add_trace(go.Scatter(x=cvDF.index, y=cvDF[col], name=col))
-
-    # update the graph elements and show
-    title = f"New COVID-19 {mode.title()} by State"
-    yaxis = f"Number of COVID-19 {mode.title()}"
-    fig.update_layout(title=title, xaxis_title="Date", yaxis_title=yaxis)
-    fig.write_html(f'{DIR_PATH}/output/new_{mode}_by_state.html')
-    if show:
-        fig.show()
+                file, cube = item
+                if file not in [files[0], files[2]]:
+                    continue
+                if want is None:
+                    want = parse_targets(targets, cube)
+                mode = 'deaths' if file == files[2] else 'cases'
+                for job in batch_jobs(*want, mode, cube):
+                    await jobs.put(job)
+            changed = await download
+        finally:
+            for _ in renderers:
+                await jobs.put(None)
+            await asyncio.gather(*renderers)
+    if failed:
+        raise failed[0]
+    return changed, written
+
+
+# in-memory copy of every file for serve(), swapped whole on reload
+_index = {}
+
+# recent request latencies in seconds, keyed by path
+_latency = collections.defaultdict(lambda: collections.deque(maxlen=10000))
+_latency_lock = threading.Lock()
+
+
+@profiled
+def build_index():
+    # copy every file into memory, along with the state and country totals,
+    # so queries never touch the disk or the shared caches
+    index = {'version': data_version(), 'regions': region_index()}
+    for file in files:
+        cube = load_cube(file)
+        scope = 'global' if 'global' in file else 'us'
+        mode = 'deaths' if 'deaths' in file else 'cases'
+        top, sub = [np.asarray(cube.meta[col], dtype=object)
+                    for col in region_columns(cube.meta)]
+
+        # rows without a county or province are named after their state or
+        # country, which is how the by province pages label them
+        labels = np.asarray([s if isinstance(s, str) else t
+                             for t, s in zip(top, sub)], dtype=object)
+        counts = np.array(cube.counts)
+        totals = cube.totals
+        population = region_population(file)
+        index[(scope, mode)] = {
+            'x': cube.dates,
+            'dates': list(cube.dates.strftime('%Y-%m-%d')),
+            'rows': cube.rows['name'],
+            'members': cube.rows['members'],
+            'labels': labels,
+            'confirmed': counts,
+            'new': np.array(cube.new),
+            'names': list(totals.index),
+            'top': {name: i for i, name in enumerate(totals.index)},
+            'totals': {'confirmed': totals.to_numpy(),
+                       'new': cube.totals_new.to_numpy()},
+            'nation': {'confirmed': cube.nation.to_numpy()[np.newaxis, :],
+                       'new': cube.nation_new.to_numpy()[np.newaxis, :]},
+            'population': population,
+            'totals_population': pd.Series(population).groupby(top).sum(
+                min_count=1).reindex(totals.index).to_numpy(),
+            'nation_population': np.array(
+                [pd.Series(population).sum(min_count=1)]),
+            'metrics': {},
+        }
+    return index
+
+
+def query(index, args):
+    # resolve a query to its page, the title fields, the trace names (None
+    # for a single line), the counts to plot (a row per day) and the file's
+    # entry in the index, a query without a region is the whole US
+    mode = args.get('mode', 'cases')
+    kind = args.get('kind', 'confirmed')
+    by = args.get('by')
+    if mode not in ['cases', 'deaths'] or \
+            kind not in ['confirmed', 'new', *METRICS]:
+        raise ValueError('mode must be cases or deaths, kind must be '
+                         f"confirmed, new or one of {', '.join(METRICS)}")
+    if 'country' in args or 'province' in args or \
+            by in ['country', 'province']:
+        scope, top, sub = 'global', 'country', 'province'
+    else:
+        scope, top, sub = 'us', 'state', 'county'
+    data = index[(scope, mode)]
+
+    # names are resolved the way the prompts do, so any spelling the index
+    # knows works and the titles use the names in the data
+    region = {}
+    if sub in args and top not in args:
+        raise ValueError(f'{sub} needs a {top}')
+    if top in args:
+        region[top] = index['regions'].resolve(args[top], (scope, None))
+    if sub in args:
+        region[sub] = index['regions'].resolve(args[sub],
+                                               (scope, region[top]))
+    if kind in ['confirmed', 'new']:
+        values, totals = data[kind], data['totals'][kind]
+        nation = data['nation'][kind]
+        page = 'conf' if kind == 'confirmed' else 'new'
+    else:
+        values, totals, nation = index_metric(data, kind)
+        page = 'metric'
+        region['metric'] = kind
+
+    if sub in region:
+        row = data['rows'].get((region[top], region[sub]))
+        if row is None:
+            raise KeyError(f'{region[sub]}, {region[top]}')
+        return f'{page}_{sub}', region, None, values[row], data
+    if top in region and by == sub:
+        # every county in the state but the unassigned cases
+        rows = data['members'][region[top]]
+        if scope == 'us':
+            rows = rows[data['labels'][rows] != 'Unassigned']
+        return f'{page}_by_{sub}', region, list(data['labels'][rows]), \
+            values[rows].transpose(), data
+    if top in region:
+        i = data['top'][region[top]]
+        return f'{page}_{top}', region, None, totals[i], data
+    if by == top:
+        return f'{page}_by_{top}', region, data['names'], \
+            totals.transpose(), data
+    if by is None and scope == 'us':
+        return f'{page}_nation', region, None, nation[0], data
+    raise ValueError(f'give a {top}, or by={top}')
+
+
+def index_metric(data, metric):
+    # a derived metric of every region, of every state or country and of
+    # the nation in an index entry, computed on first use
+    if metric not in data['metrics']:
+        data['metrics'][metric] = (
+            compute_metric(metric, data['confirmed'], data['new'],
+                           data['population']),
+            compute_metric(metric, data['totals']['confirmed'],
+                           data['totals']['new'], data['totals_population']),
+            compute_metric(metric, data['nation']['confirmed'],
+                           data['nation']['new'], data['nation_population']))
+    return data['metrics'][metric]
+
+
+def serve_series(index, args):
+    # answers are cached by query, for the data the index was built from
+    key = ('series', tuple(sorted(args.items())))
+    return results.get(key, lambda: answer_series(index, args),
+                       index['version'])
+
+
+def answer_series(index, args):
+    page, region, names, y, data = query(index, args)
+    region.pop('metric', None)
+    series = {**region, 'mode': args.get('mode', 'cases'),
+              'kind': args.get('kind', 'confirmed'), 'dates': data['dates']}
+    if y.dtype.kind == 'f':
+        # gaps in the metrics become nulls, json has no nan
+        y = np.where(np.isnan(y), None, np.round(y.astype('float64'), 4))
+    if names is None:
+        series['values'] = y.tolist()
+    else:
+        series['series'] = dict(zip(names, y.transpose().tolist()))
+    return 'application/json', json.dumps(series).encode()
+
+
+def serve_figure(index, args):
+    key = ('figure', tuple(sorted(args.items())))
+    return results.get(key, lambda: answer_figure(index, args),
+                       index['version'])
+
 
+def answer_figure(index, args):
+    page, region, names, y, data = query(index, args)
+    fig = make_figure(page, args.get('mode', 'cases'), data['x'], y, names,
+                      **region)
+    html = fig.to_html(include_plotlyjs='/plotly.min.js')
+    return 'text/html; charset=utf-8', html.encode()
 
-def generate_docs():
-    local = ['conf_cases_by_state', 'conf_cases_North Carolina', 'conf_cases_North Carolina_by_county', 'conf_cases_Wake', 'conf_deaths_by_state', 'conf_deaths_North Carolina', 'conf_deaths_North Carolina_by_county', 'conf_deaths_Wake',
-             'new_cases_by_state', 'new_cases_North Carolina', 'new_cases_North Carolina_by_county', 'new_cases_Wake', 'new_deaths_by_state', 'new_deaths_North Carolina', 'new_deaths_North Carolina_by_county', 'new_deaths_Wake']
-    for f in local:
-        src = f'{DIR_PATH}/output/{f}.html'
-        dst = f'{DIR_PATH}/docs/{f}.html'
-        shutil.copyfile(src, dst)
 
-    with open(f'{DIR_PATH}/docs/index.html', 'r') as f:
+def serve_regions(index, args):
+    # names close to q, for search boxes: states, or the counties of state,
+    # or with scope=global countries, or the provinces of country
+    if 'q' not in args:
+        raise ValueError('give q, the name to search for')
+    regions = index['regions']
+    if 'country' in args or args.get('scope') == 'global':
+        scope, top = 'global', 'country'
+    else:
+        scope, top = 'us', 'state'
+    group = (scope, None)
+    if top in args:
+        group = (scope, regions.resolve(args[top], group))
+    found = regions.lookup(args['q'], group)
+    matches = [found] if found else []
+    matches += [name for name in regions.suggest(args['q'], group)
+                if name != found]
+    return 'application/json', json.dumps({'matches': matches}).encode()
+
+
+def serve_stats(index, args):
+    # request count and median and 99th percentile latency per path
+    with _latency_lock:
+        latency = {path: list(times) for path, times in _latency.items()}
+    data = {}
+    for path, times in latency.items():
+        p50, p99 = np.percentile(times, [50, 99]) * 1000
+        data[path] = {'requests': len(times), 'p50_ms': round(p50, 3),
+                      'p99_ms': round(p99, 3)}
+    data['cache'] = results.summary()
+    return 'application/json', json.dumps(data).encode()
+
+
+def serve_plotlyjs(index, args):
+    return 'application/javascript', PLOTLYJS_BYTES
+
+
+ROUTES = {'/series': serve_series, '/figure': serve_figure,
+          '/regions': serve_regions, '/stats': serve_stats,
+          '/plotly.min.js': serve_plotlyjs}
+PLOTLYJS_BYTES = b''
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        started = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        args = dict(urllib.parse.parse_qsl(url.query))
+        route = ROUTES.get(url.path)
+        try:
+            if route is None:
+                raise LookupError(f'{url.path} not found')
+            # the index is read once, so a reload mid request is harmless
+            status = 200
+            with stage(url.path):
+                kind, body = route(_index, args)
+        except LookupError as e:
+            status = 404
+            kind, body = 'application/json', json.dumps(
+                {'error': f'{e.args[0]} not recognized'
+                 if isinstance(e, KeyError) else str(e)}).encode()
+        except ValueError as e:
+            status = 400
+            kind, body = 'application/json', json.dumps(
+                {'error': str(e)}).encode()
+        except Exception as e:
+            # anything else is a bug, the client still gets an answer
+            self.log_error('%s failed: %r', url.path, e)
+            status = 500
+            kind, body = 'application/json', json.dumps(
+                {'error': 'internal error'}).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if route is not None:
+            with _latency_lock:
+                _latency[url.path].append(time.perf_counter() - started)
+
+
+def reload_forever(every, url=None):
+    # poll for new data and swap in a fresh index when any file changed
+    # a failed update keeps the old index, and polling carries on
+    global _index
+    while True:
+        time.sleep(every)
+        try:
+            changed = download_files(url)
+            if changed:
+                _index = build_index()
+                print(f"Reloaded with new data for {', '.join(changed)}")
+        except Exception as e:
+            print(f'Update failed: {e!r}')
+
+
+def serve(host='127.0.0.1', port=8000, every=3600, url=None):
+    # answer queries from memory until interrupted
+    global _index, PLOTLYJS_BYTES
+    _index = build_index()
+    PLOTLYJS_BYTES = plotly.offline.get_plotlyjs().encode()
+    threading.Thread(target=reload_forever, args=(every, url),
+                     daemon=True).start()
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f'Serving on http://{host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# page listing a state's graphs and its counties' graphs in docs/
+DOCS_PAGE = """<!DOCTYPE html>
+<html>
+
+<head>
+  <title>COVID-19 Graphs for {region}</title>
+
+  <meta charset="utf-8">
+  <meta http-equiv="content-type" content="text/html; charset=UTF-8" />
+
+  <link rel="stylesheet" href="../style.css">
+
+</head>
+
+<body>
+
+  <h1 style="color: white;">COVID-19 Graphs for {region}</h1>
+  <p><a href="../index.html">All graphs</a></p>
+  <br>
+{links}
+</body>
+
+</html>
+"""
+
+# lines of docs/index.html between these are rewritten by generate_docs()
+DOCS_START, DOCS_END = '  <!-- pages -->', '  <!-- /pages -->'
+
+
+def page_hash(job):
+    # changes whenever the page's data or the way it is drawn does
+    digest = hashlib.sha256(repr((
+        job['page'], job['mode'], job.get('names'),
+        sorted((k, v) for k, v in job.items() if k in ['state', 'county']),
+        PLOTLYJS, PRECOMPRESS, WEBGL, MAX_POINTS,
+        plotly.__version__)).encode())
+    digest.update(np.asarray(job['x'], dtype='datetime64[D]').tobytes())
+    digest.update(np.ascontiguousarray(job['y']).tobytes())
+    return digest.hexdigest()
+
+
+def link_file(src, dst):
+    # dst becomes src, swapped in whole so the site is never half written
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    part = f'{dst}.{os.getpid()}.part'
+    if os.path.exists(part):
+        os.remove(part)
+    link_or_copy(src, part)
+    os.replace(part, dst)
+
+
+def docs_links(pages, prefix=''):
+    # a line per graph, its total and new counts side by side
+    # pages maps (page, mode, region) to the page's title and path, they are
+    # listed by county, then the single region graphs before the by county
+    # or by state ones, then cases before deaths
+    lines = []
+    for page, mode, region in sorted(pages, key=lambda key: (
+            dict(key[2]).get('county', ''), '_by_' in key[0], key[1])):
+        if not page.startswith('conf_'):
+            continue
+        title, path = pages[(page, mode, region)]
+        new_title, new_path = pages[(page.replace('conf_', 'new_', 1), mode,
+                                     region)]
+        links = [f'<a href="{urllib.parse.quote(prefix + p)}" '
+                 f'target="_blank" rel="noopener noreferrer">{t}</a>'
+                 for t, p in [(title, path), (new_title, new_path)]]
+        lines.append(f"  <p>{'  //  '.join(links)}</p>")
+    return lines
+
+
+def update_file(path, text):
+    # only rewrite a page whose text changed
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return
+    write_file(path, text)
+
+
+@profiled
+def generate_docs(targets=('Wake, North Carolina',), workers=None):
+    # publish the graphs of the targets to docs/, with the US graphs and a
+    # link to every state's page on the index, and a page per state with
+    # its graphs and its counties' graphs
+    # targets are the same as for batch()
+    docs = f'{DIR_PATH}/docs'
+    want_states, want_counties = parse_targets(targets)
+    jobs = batch_jobs(want_states, want_counties, 'cases') + \
+        batch_jobs(want_states, want_counties, 'deaths')
+    paths = [page_file(job['page'], job['mode'], job.get('folder', ''),
+                       **{k: job[k] for k in ['state', 'county'] if k in job})
+             for job in jobs]
+
+    # docs/manifest.json has the hash of every published page, so only the
+    # pages whose data changed are built again, and the states with a page
+    manifest = {'pages': {}, 'states': []}
+    if os.path.exists(f'{docs}/manifest.json'):
+        with open(f'{docs}/manifest.json', 'r') as f:
+            manifest = json.load(f)
+    hashes = {path: page_hash(job) for path, job in zip(paths, jobs)}
+    todo = [(path, job) for path, job in zip(paths, jobs)
+            if manifest['pages'].get(path) != hashes[path] or
+            not os.path.exists(f'{docs}/{path}')]
+
+    # the changed pages are built in output/ by the worker pool and then
+    # linked into docs/, pages that are no longer published are removed
+    built = render_jobs([job for _, job in todo], workers) if todo else []
+    published = [(path, src) for (path, _), src in zip(todo, built)]
+    if PLOTLYJS == 'shared':
+        published.append(('plotly.min.js', plotlyjs_path()))
+    for path, src in published:
+        dst = f'{docs}/{path}'
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        link_file(src, dst)
+        if PRECOMPRESS:
+            link_file(f'{src}.gz', f'{dst}.gz')
+    stale = [f'{docs}/{path}' for path in set(manifest['pages']) - set(hashes)]
+    stale += [f'{docs}/{state}/index.html'
+              for state in set(manifest['states']) - want_states]
+    for path in stale:
+        for f in [path, f'{path}.gz']:
+            if os.path.exists(f):
+                os.remove(f)
+        folder = os.path.dirname(path)
+        if folder != docs and os.path.isdir(folder) and \
+                not os.listdir(folder):
+            os.rmdir(folder)
+    write_durably(f'{docs}/manifest.json', json.dumps(
+        {'pages': hashes, 'states': sorted(want_states)}, indent=2))
+
+    # titles and paths of every page, by the state whose page lists them,
+    # None for the index
+    pages = collections.defaultdict(dict)
+    for path, job in zip(paths, jobs):
+        region = tuple((k, job[k]) for k in ['state', 'county'] if k in job)
+        title = PAGES[job['page']][0].format(Mode=job['mode'].title(),
+                                             **dict(region))
+        pages[job.get('state')][(job['page'], job['mode'], region)] = \
+            (title, path)
+
+    # a page per state, its own graphs first and then its counties'
+    for state in sorted(want_states):
+        os.makedirs(f'{docs}/{state}', exist_ok=True)
+        lines = docs_links(pages[state], '../')
+        update_file(f'{docs}/{state}/index.html', DOCS_PAGE.format(
+            region=state, links='\n'.join(lines)))
+
+    # the index: the US graphs and a link to every state's page
+    lines = docs_links(pages[None])
+    lines += [f'  <p><a href="{urllib.parse.quote(state)}/index.html">'
+              f'{state}</a></p>' for state in sorted(want_states)]
+    with open(f'{docs}/index.html', 'r') as f:
         contents = f.read().splitlines()
+    if DOCS_START in contents and DOCS_END in contents:
+        start, end = contents.index(DOCS_START), contents.index(DOCS_END)
+        contents[start + 1:end] = lines
     for i in range(len(contents)):
         if '  <p id="update" style="font-style: italic;">' in contents[i]:
             contents[i] = '  <p id="update" style="font-style: italic;">'
             timestamp = datetime.datetime.now().strftime("%B %d, %Y")
             inner = f"These graphs were last updated: {timestamp}."
             contents[i] += inner + '</p>'
-    with open(f'{DIR_PATH}/docs/index.html', 'w') as f:
-        f.write('\n'.join(contents))
+    update_file(f'{docs}/index.html', '\n'.join(contents))
+    return len(todo)
+
+
+# page that plots the files of export_data(), loading a region's file only
+# when it is picked
+VIEWER_PAGE = """<!DOCTYPE html>
+<html>
+
+<head>
+  <title>COVID-19 Graphs</title>
+
+  <meta charset="utf-8">
+  <script src="plotly.min.js"></script>
+
+</head>
+
+<body>
+
+  <select id="state"></select>
+  <select id="county"></select>
+  <select id="mode">
+    <option value="0">Cases</option>
+    <option value="1">Deaths</option>
+  </select>
+  <div id="confirmed"></div>
+  <div id="new"></div>
+
+  <script>
+    const $ = id => document.getElementById(id);
+    const loaded = new Map();
+    let regions, dates;
+
+    // a region's counts, confirmed and new cases then confirmed and new
+    // deaths, each stored as the first day and then the change every day
+    function load(file) {
+      if (!loaded.has(file)) {
+        loaded.set(file, fetch('data/' + file).then(async response => {
+          const body = response.body.pipeThrough(
+            new DecompressionStream('gzip'));
+          const values = new Int32Array(
+            await new Response(body).arrayBuffer());
+          for (let start = 0; start < values.length; start += dates.length) {
+            for (let i = start + 1; i < start + dates.length; i++) {
+              values[i] += values[i - 1];
+            }
+          }
+          return values;
+        }));
+      }
+      return loaded.get(file);
+    }
+
+    async function draw() {
+      const state = regions.states[$('state').value];
+      const county = $('county').value;
+      const file = county ? state.counties[county] :
+        $('state').value ? state.file : regions.US;
+      const place = county ? county + ' County' :
+        $('state').value || 'the US';
+      const mode = Number($('mode').value);
+      const Mode = mode ? 'Deaths' : 'Cases';
+      const values = await load(file);
+      const series = i => values.subarray(i * dates.length,
+                                          (i + 1) * dates.length);
+      for (const [id, title, i] of [
+          ['confirmed', `Total Confirmed COVID-19 ${Mode} in ${place}`, 0],
+          ['new', `New COVID-19 ${Mode} in ${place}`, 1]]) {
+        Plotly.react($(id), [{x: dates, y: Array.from(series(2 * mode + i)),
+                               type: 'scatter', mode: 'lines'}],
+                     {title: title, xaxis: {title: 'Date'},
+                      yaxis: {title: `Number of COVID-19 ${Mode}`}});
+      }
+    }
+
+    function options(select, names, blank) {
+      select.replaceChildren(...[blank, ...names].map(name => {
+        const option = document.createElement('option');
+        option.value = name === blank ? '' : name;
+        option.text = name;
+        return option;
+      }));
+    }
+
+    fetch('data/regions.json').then(response => response.json())
+      .then(index => {
+        regions = index;
+        const start = Date.parse(index.start);
+        dates = Array.from({length: index.days},
+          (_, i) => new Date(start + i * 86400000).toISOString()
+            .slice(0, 10));
+        options($('state'), Object.keys(index.states), 'US');
+        options($('county'), [], 'All counties');
+        $('state').onchange = () => {
+          const state = index.states[$('state').value];
+          options($('county'), state ? Object.keys(state.counties) : [],
+                  'All counties');
+          draw();
+        };
+        $('county').onchange = draw;
+        $('mode').onchange = draw;
+        draw();
+      });
+  </script>
+
+</body>
+
+</html>
+"""
+
+
+def delta_encode(block):
+    # int32 counts as the first day and then the change every day, which
+    # compresses far better than the running totals
+    block = np.asarray(block, dtype='int64')
+    return np.diff(block, axis=-1, prepend=0).astype('<i4')
+
+
+@profiled
+def export_data():
+    # the counts of the US, every state and every county as a small
+    # gzipped file each, with regions.json naming them and viewer.html
+    # plotting them, so a site only sends the regions that are looked at
+    # a file holds the confirmed and new cases and then the confirmed and
+    # new deaths, delta encoded int32 of every day in regions.json's range
+    # returns the number of data files written
+    folder = os.path.join(DIR_PATH, 'output', 'data')
+    os.makedirs(folder, exist_ok=True)
+    cases, deaths = load_cube(files[0]), load_cube(files[2])
+    days = min(len(cases.dates), len(deaths.dates))
+
+    def write(name, blocks):
+        data = delta_encode(np.stack([b[..., :days] for b in blocks],
+                                     axis=-2))
+        # level 6 is within a few percent of 9 on these and much faster
+        write_bytes(os.path.join(folder, name),
+                    gzip.compress(data.tobytes(), compresslevel=6, mtime=0))
+
+    # the nation, then the states, by their position in the state totals
+    write('US.bin.gz', [cases.nation.to_numpy(), cases.nation_new.to_numpy(),
+                        deaths.nation.to_numpy(),
+                        deaths.nation_new.to_numpy()])
+    states = {}
+    for i, state in enumerate(cases.totals.index):
+        blocks = [cases.totals.loc[state], cases.totals_new.loc[state]]
+        if state in deaths.totals.index:
+            blocks += [deaths.totals.loc[state], deaths.totals_new.loc[state]]
+        else:
+            blocks += [np.zeros(days, dtype='int64')] * 2
+        write(f's{i}.bin.gz', [np.asarray(b) for b in blocks])
+        states[state] = {'file': f's{i}.bin.gz', 'counties': {}}
+
+    # counties by UID, the deaths file's rows are matched up by name
+    written = len(states) + 1
+    for (state, county), row in cases.rows['name'].items():
+        if not isinstance(county, str):
+            continue
+        other = deaths.rows['name'].get((state, county))
+        blocks = [cases.counts[row], cases.new[row]]
+        if other is None:
+            blocks += [np.zeros(days, dtype='int64')] * 2
+        else:
+            blocks += [deaths.counts[other], deaths.new[other]]
+        name = f"c{int(cases.meta['UID'][row])}.bin.gz"
+        write(name, blocks)
+        states[state]['counties'][county] = name
+        written += 1
+
+    index = {'start': str(cases.dates[0].date()), 'days': days,
+             'US': 'US.bin.gz', 'states': states}
+    write_bytes(os.path.join(folder, 'regions.json'),
+                json.dumps(index, separators=(',', ':')).encode())
+    plotlyjs_path()
+    write_file(os.path.join(DIR_PATH, 'output', 'viewer.html'), VIEWER_PAGE)
+    return written
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Plot Johns Hopkins COVID-19 data on interactive graphs.')
+    parser.add_argument('--batch', nargs='+', metavar='TARGET',
+                        help="build pages without prompting, for 'all' or "
+                             "for states and 'County, State' pairs")
+    parser.add_argument('--async', dest='pipeline', action='store_true',
+                        help='with --batch, render pages while the other '
+                             'files are still downloading')
+    parser.add_argument('--workers', type=int,
+                        help='processes used by --batch and --docs '
+                             '(default: all cores)')
+    parser.add_argument('--docs', nargs='*', metavar='TARGET',
+                        help='publish the pages for these targets (like '
+                             "--batch, default 'Wake, North Carolina') to "
+                             'docs/, rebuilding only the pages that changed')
+    parser.add_argument('--embed-plotlyjs', action='store_true',
+                        help='put plotly.js in every page instead of one '
+                             'shared copy in output/')
+    parser.add_argument('--gzip', action='store_true',
+                        help='also write a gzipped copy of every page')
+    parser.add_argument('--webgl', action='store_true',
+                        help='draw the by county/state traces with WebGL')
+    parser.add_argument('--max-points', type=int, metavar='N',
+                        help='keep about N points per by county/state trace, '
+                             'lowest and highest days first')
+    parser.add_argument('--serve', action='store_true',
+                        help='answer /series, /figure and /stats queries '
+                             'over http instead of prompting')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address for --serve (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port for --serve (default: %(default)s)')
+    parser.add_argument('--reload', type=int, default=3600, metavar='SECONDS',
+                        help='how often --serve checks for new data '
+                             '(default: %(default)s)')
+    parser.add_argument('--cache-mb', type=int, default=256, metavar='MB',
+                        help='memory kept for rendered pages and query '
+                             'answers (default: %(default)s)')
+    parser.add_argument('--disk-cache', action='store_true',
+                        help='also keep rendered pages and query answers in '
+                             'input/cache/ for later runs')
+    parser.add_argument('--profile', nargs='?', const='', metavar='PATH',
+                        help='time every stage and write a trace to PATH '
+                             '(default: output/profile.json)')
+    parser.add_argument('--metrics', nargs='+', default=[],
+                        choices=list(METRICS), metavar='METRIC',
+                        help='also plot these derived metrics: '
+                             f"{', '.join(METRICS)}")
+    parser.add_argument('--export', action='store_true',
+                        help='write every US region as a small data file to '
+                             'output/data/ with a page to view them, '
+                             'output/viewer.html')
+    parser.add_argument('--redistribute', action='store_true',
+                        help='spread negative days and backlog spikes in '
+                             'the new counts back over the days before them')
+    parser.add_argument('--anomalies', action='store_true',
+                        help='write the negative days, spikes and reporting '
+                             'gaps of every region to output/')
+    parser.add_argument('--country',
+                        help='plot a country from the global files instead '
+                             'of a US state and county')
+    parser.add_argument('--province',
+                        help='also plot one province/state of --country')
+    args = parser.parse_args()
+    set_html_options('embed' if args.embed_plotlyjs else 'shared', args.gzip,
+                     args.webgl, args.max_points)
+    set_cache_options(args.cache_mb << 20, args.disk_cache)
+    set_quality_options(args.redistribute)
+    if args.profile is not None:
+        # written on the way out, however the run ends
+        set_profile(True)
+        atexit.register(write_profile, args.profile or
+                        os.path.join(DIR_PATH, 'output', 'profile.json'))
+
     # prep, check for updates, download updates
     make_dirs()
-    new = check_updates()
-    if new:
-        print("Downloading new data...")
-        download_files()
+    if args.batch and args.pipeline:
+        started = time.perf_counter()
+        changed, written = asyncio.run(pipeline(args.batch,
+                                                workers=args.workers))
+        print("Updates! Proceeding... " if changed else "No updates.")
+        print(f"Wrote {written} figures in "
+              f"{time.perf_counter() - started:.1f}s")
+        return
+    check_updates()
+
+    # build the requested pages and stop
+    if args.batch:
+        batch(args.batch, args.workers)
+        return
+    if args.anomalies:
+        for file in files:
+            report = anomaly_report(file)
+            name = os.path.splitext(file)[0].replace('time_series_covid19',
+                                                     'anomalies')
+            report.to_csv(os.path.join(DIR_PATH, 'output', f'{name}.csv'),
+                          index=False)
+            print(f'{file}: {len(report)} regions with anomalies')
+        return
+    if args.export:
+        written = export_data()
+        print(f'Exported {written} regions to output/data/')
+        return
+    if args.docs is not None:
+        written = generate_docs(args.docs or ('Wake, North Carolina',),
+                                args.workers)
+        print(f'Published {written} changed pages to docs/')
+        return
+    if args.serve:
+        serve(args.host, args.port, args.reload)
+        return
+
+    # plot a country and optionally one of its provinces
+    if args.country:
+        regions = region_index()
+        try:
+            args.country = regions.resolve(args.country, ('global', None))
+            if args.province:
+                args.province = regions.resolve(args.province,
+                                                ('global', args.country))
+        except LookupError as e:
+            print(e)
+            return
+        for mode in ['cases', 'deaths']:
+            confirmed_country(args.country, mode, True)
+            new_country(args.country, mode, True)
+            if args.province:
+                confirmed_province(args.country, args.province, mode, True)
+                new_province(args.country, args.province, mode, True)
+            confirmed_by_province(args.country, mode, True)
+            new_by_province(args.country, mode, True)
+            confirmed_by_country(mode, True)
+            new_by_country(mode, True)
+        return
 
     # collect state/county input
-    cvDF = pd.read_csv(f'{DIR_PATH}/input/{files[0]}', encoding='utf-8')
-    state = input("Enter your state: ").lower().title()
-    while state not in cvDF['Province_State'].unique():
-        print(f'{state} not recognized!')
-        state = input("Enter your state: ").lower().title()
-    county = input("Enter your county: ").lower().title()
-    cvDF = cvDF.loc[cvDF['Province_State'] == state]
-    while county not in cvDF['Admin2'].unique():
-        print(f'{county} not recognized!')
-        county = input("Enter your county: ").lower().title()
+    state = ask("Enter your state: ", ('us', None))
+    county = ask("Enter your county: ", ('us', state))
 
     # prepare plots
     for mode in ['cases', 'deaths']:
@@ -573,6 +2978,10 @@ def main():
         new_by_county(state, mode, True)
         confirmed_by_state(mode, True)
         new_by_state(mode, True)
+        confirmed_nation(mode, True)
+        new_nation(mode, True)
+        for metric in args.metrics:
+            metric_pages(metric, state, county, mode, True)
 
     # generates sample plots for docs - not needed
     # generate_docs()